@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+Benchmark writing DAG and HTCondor submit files, for different numbers of nodes.
+
+Compares building the whole file contents as one string in memory
+(DAGMan.generate_dag_contents(), JobSet.generate_file_contents()) against
+streaming them to file (DAGMan.write(), JobSet.write()).
+
+Each measurement is run in a separate process, so that the peak memory
+(max RSS) of one does not affect the others. Use --python to run them with
+several interpreters, e.g. to compare Python 2 & 3. The time to import
+htcondenser is also measured.
+
+Usage:
+
+    python bench_file_generation.py [-n 1000 10000 100000] [--python python2 python3]
+"""
+
+
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import_start = time.time()
+import htcondenser as ht  # noqa: E402
+IMPORT_TIME = time.time() - import_start
+
+
+METHODS = ['dag_string', 'dag_stream', 'submit_string', 'submit_stream']
+
+
+def max_rss_mb():
+    """Get peak memory usage of this process so far, in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def build_dag(n_nodes, work_dir):
+    """Make a DAG of `n_nodes` jobs: one root job, with every other job its child."""
+    job_set = ht.JobSet(exe='./bench.sh',
+                        filename=os.path.join(work_dir, 'bench.condor'),
+                        out_dir=work_dir, err_dir=work_dir, log_dir=work_dir,
+                        hdfs_store=os.path.join(work_dir, 'hdfs'))
+    dag = ht.DAGMan(filename=os.path.join(work_dir, 'bench.dag'),
+                    status_file=os.path.join(work_dir, 'bench.status'))
+    for i in range(n_nodes):
+        job = ht.Job(name='job%d' % i,
+                     args=['input_%d.root' % i, 'output_%d.root' % i, '--option', str(i)],
+                     input_files=['input_%d.root' % i],
+                     output_files=['output_%d.root' % i])
+        job_set.add_job(job)
+        dag.add_job(job, requires=None if i == 0 else ['job0'], retry=2)
+    return job_set, dag
+
+
+def run_one(n_nodes, method):
+    """Time one method for a DAG with `n_nodes` nodes, print time & memory."""
+    work_dir = tempfile.mkdtemp()
+    try:
+        job_set, dag = build_dag(n_nodes, work_dir)
+        rss_before = max_rss_mb()
+        start = time.time()
+        if method == 'dag_string':
+            contents = dag.generate_dag_contents()
+            with open(dag.dag_filename, 'w') as dfile:
+                dfile.write(contents)
+        elif method == 'dag_stream':
+            with open(dag.dag_filename, 'w') as dfile:
+                for line in dag.generate_dag_lines():
+                    dfile.write(line + '\n')
+        elif method == 'submit_string':
+            with open(job_set.job_template) as tfile:
+                contents = job_set.generate_file_contents(tfile.read())
+            with open(job_set.filename, 'w') as jfile:
+                jfile.write(contents)
+        elif method == 'submit_stream':
+            job_set.write(dag_mode=False)
+        duration = time.time() - start
+        print('%d %s %.3f %.1f' % (n_nodes, method, duration, max_rss_mb() - rss_before))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def run_benchmark(python, bench_args):
+    """Run this script with interpreter `python` & arguments `bench_args`, and get its output."""
+    proc = subprocess.Popen([python, os.path.abspath(__file__)] + bench_args,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    out, _ = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError('Benchmark %s with %s failed' % (' '.join(bench_args), python))
+    return out
+
+
+def main(in_args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--nodes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Number(s) of DAG nodes to benchmark')
+    parser.add_argument('--python', nargs='+', default=[sys.executable],
+                        help='Python interpreter(s) to run the benchmarks with')
+    parser.add_argument('--run', nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument('--version', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(in_args)
+
+    if args.version:
+        print('%s %.4f' % (sys.version.split()[0], IMPORT_TIME))
+        return
+    if args.run:
+        run_one(int(args.run[0]), args.run[1])
+        return
+
+    versions = {}
+    for python in args.python:
+        version, import_time = run_benchmark(python, ['--version']).split()
+        versions[python] = version
+        print('Python %s (%s): import htcondenser in %.1f ms' % (
+              version, python, 1000 * float(import_time)))
+    row_format = '%-8s %-10s %-14s %10s %16s'
+    print(row_format % ('Nodes', 'Python', 'Method', 'Time [s]', 'Peak RSS [MB]'))
+    for n_nodes in args.nodes:
+        for method in METHODS:
+            for python in args.python:
+                _, _, duration, rss = run_benchmark(python, ['--run', str(n_nodes), method]).split()
+                print(row_format % (n_nodes, versions[python], method, duration, rss))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ But more complicated, as jobs A and D run one script,
 whilst jobs B and C run another (with separate args)
 """
 
+from __future__ import print_function
 import os
 import htcondenser as ht
 
@@ -54,9 +55,9 @@ dag_man.add_job(jobC, requires=[jobA])
 dag_man.add_job(jobD, requires=[jobB, jobC])
 
 # Can easily iterate over jobs in a DAGMan
-print 'My JobSet has', len(dag_man), 'jobs:'
+print('My JobSet has', len(dag_man), 'jobs:')
 for job in dag_man:
-    print job.name, 'running:', job.manager.exe, ' '.join(job.args)
+    print(job.name, 'running:', job.manager.exe, ' '.join(job.args))
 
 # dag_man.write()
 dag_man.submit(force=True)
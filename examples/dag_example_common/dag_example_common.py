@@ -5,6 +5,7 @@ Diamond DAG example
 Exploits common_input_files.
 """
 
+from __future__ import print_function
 import os
 import htcondenser as ht
 
@@ -47,8 +48,8 @@ dag_man.add_job(jobC, requires=[jobA])
 dag_man.add_job(jobD, requires=[jobB, jobC])
 
 # Can easily iterate over jobs in a DAGMan
-print 'My JobSet has', len(dag_man), 'jobs:'
+print('My JobSet has', len(dag_man), 'jobs:')
 for job in dag_man:
-    print job.name, 'running:', job.manager.exe, ' '.join(job.args)
+    print(job.name, 'running:', job.manager.exe, ' '.join(job.args))
 
 dag_man.submit(force=True)
@@ -21,6 +21,7 @@ Alternatively, you can manually move them to a pre-assigned location on HDFS.
 """
 
 
+from __future__ import print_function
 import os
 import htcondenser as ht
 
@@ -59,9 +60,9 @@ for i, word in enumerate(['Easter', 'NYE', 'Summer']):
     job_set.add_job(job)
 
 # Can easily iterate over jobs in a JobSet
-print 'My JobSet has', len(job_set), 'jobs:'
+print('My JobSet has', len(job_set), 'jobs:')
 for job in job_set:
-    print job.name, 'running:', job_set.exe, ' '.join(job.args)
+    print(job.name, 'running:', job_set.exe, ' '.join(job.args))
 
 # Now submit jobs
 job_set.submit()
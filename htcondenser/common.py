@@ -6,11 +6,32 @@ import os
 from subprocess import check_call, Popen, PIPE
 import shutil
 import datetime
+import hashlib
+import json
+import socket
+import tempfile
+import threading
+from collections import OrderedDict
 
 
 log = logging.getLogger(__name__)
 
 
+# Cache of file hashes, key is real filepath, value is (size, mtime, hash).
+# Saves re-hashing files that have not changed since they were last hashed.
+_FILE_HASH_CACHE = {}
+
+# Absolute paths of directories that this process has already created or
+# found to exist, so they need not be checked again. See check_dirs_create().
+_KNOWN_DIRS = set()
+
+# Type of str & unicode job names on Python 2, and str on Python 3
+try:
+    string_types = basestring  # noqa: F821
+except NameError:
+    string_types = str
+
+
 class FileMirror(object):
     """Simple class to store location of mirrored files: the original,
     the copy of HDFS, and the copy on the worker node."""
@@ -21,14 +42,534 @@ class FileMirror(object):
         self.worker = worker
 
     def __repr__(self):
-        arg_str = ', '.join(['%s=%s' % (k, v) for k, v in self.__dict__.iteritems()])
+        arg_str = ', '.join(['%s=%s' % (k, v) for k, v in self.__dict__.items()])
         return 'FileMirror(%s)' % (arg_str)
 
     def __str__(self):
-        arg_str = ', '.join(['%s=%s' % (k, v) for k, v in self.__dict__.iteritems()])
+        arg_str = ', '.join(['%s=%s' % (k, v) for k, v in self.__dict__.items()])
         return 'FileMirror(%s)' % arg_str
 
 
+class IndexedDict(object):
+    """Ordered mapping whose values can also be got by position.
+
+    Like an OrderedDict without deletion, but getting the value at a
+    position takes constant time, and a slice time proportional to its
+    length, rather than building a list of all the values each time.
+    """
+
+    def __init__(self):
+        super(IndexedDict, self).__init__()
+        self._positions = {}  # key is key, value is its position
+        self._keys = []
+        self._values = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def __iter__(self):
+        """Iterate over keys, in the order they were added."""
+        return iter(self._keys)
+
+    def __getitem__(self, key):
+        return self._values[self._positions[key]]
+
+    def __setitem__(self, key, value):
+        """Set the value for a key. A new key goes at the end, an existing
+        key keeps its position."""
+        position = self._positions.get(key)
+        if position is None:
+            self._positions[key] = len(self._keys)
+            self._keys.append(key)
+            self._values.append(value)
+        else:
+            self._values[position] = value
+
+    def get(self, key, default=None):
+        position = self._positions.get(key)
+        return default if position is None else self._values[position]
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return list(zip(self._keys, self._values))
+
+    def value_at(self, index):
+        """Get the value(s) at a position (or slice) in the order they were added.
+
+        Parameters
+        ----------
+        index : int or slice
+
+        Returns
+        -------
+        object or list
+        """
+        return self._values[index]
+
+
+def generate_input_arg_parts(mirrors, transfer_hdfs_input, option='--copyToLocal'):
+    """Generate the condor_worker.py options to fetch input files, and the
+    replacement for each input file in the exe arguments.
+
+    Parameters
+    ----------
+    mirrors : iterable[FileMirror]
+        Mirrors of input files.
+
+    transfer_hdfs_input : bool
+        If True, all files are copied to the worker node and replaced in the
+        exe arguments by their worker copies. Otherwise they are replaced by
+        their HDFS copies, and files already on HDFS are not copied.
+
+    option : str, optional
+        condor_worker.py option to use for each file.
+
+    Returns
+    -------
+    list[str], dict
+        Options for condor_worker.py, and dict of {original filepath:
+        replacement}. If several mirrors have the same original, the first is used.
+    """
+    copy_args = []
+    replacements = {}
+    for ifile in mirrors:
+        if transfer_hdfs_input:
+            replacements.setdefault(ifile.original, ifile.worker)
+            copy_args.extend([option, ifile.hdfs, ifile.worker])
+        else:
+            replacements.setdefault(ifile.original, ifile.hdfs)
+            if not ifile.original.startswith('/hdfs'):
+                copy_args.extend([option, ifile.hdfs, ifile.worker])
+    return copy_args, replacements
+
+
+def join_worker_args(args):
+    """Convert arguments for condor_worker.py to one string, escaping double
+    quotes for HTCondor.
+
+    Parameters
+    ----------
+    args : list
+        Arguments, converted to str.
+
+    Returns
+    -------
+    str
+    """
+    return ' '.join([str(x).replace('"', '""') for x in args])
+
+
+def is_hdfs_path(path):
+    """Check if a filepath is on HDFS, i.e. starts with /hdfs"""
+    return os.path.abspath(path).startswith('/hdfs')
+
+
+def strip_hdfs_prefix(path):
+    """Convert a /hdfs/... filepath into a path for use with HDFS tools."""
+    return os.path.abspath(path).replace('/hdfs', '', 1)
+
+
+def _list_local_status(directory):
+    """Get {name: (is directory, size in bytes)} for a local directory's contents."""
+    status = {}
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        status[name] = (os.path.isdir(path), os.path.getsize(path))
+    return status
+
+
+class HadoopCLIBackend(object):
+    """Filesystem backend for HDFS that uses the hadoop command line tools.
+
+    Checks for existing files and directories are done via the /hdfs mount.
+    Every mkdir or copy starts a new hadoop process, so it is best to operate
+    on several paths per call where possible.
+
+    All paths are full filepaths, /hdfs/...
+    """
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def list_status(self, path):
+        """Get {name: (is directory, size in bytes)} for a directory's contents."""
+        return _list_local_status(path)
+
+    # Maximum number of paths per hadoop command, to stay within the
+    # limit on command line length.
+    MAX_PATHS_PER_CALL = 500
+
+    def mkdirs(self, paths):
+        """Make directories, including any parents."""
+        paths = [strip_hdfs_prefix(p) for p in paths]
+        for i in range(0, len(paths), self.MAX_PATHS_PER_CALL):
+            check_call(['hadoop', 'fs', '-mkdir', '-p'] + paths[i:i + self.MAX_PATHS_PER_CALL])
+
+    def copy(self, src, dest, force=True):
+        """Copy a file or directory, where one or both of `src` and `dest` are on HDFS."""
+        flag_src_hdfs = is_hdfs_path(src)
+        flag_dest_hdfs = is_hdfs_path(dest)
+        hadoop_cmd = '-cp'
+        if not flag_dest_hdfs:
+            hadoop_cmd = '-copyToLocal'
+        elif not flag_src_hdfs:
+            hadoop_cmd = '-copyFromLocal'
+        cmds = ['hadoop', 'fs', hadoop_cmd]
+        if force:
+            cmds.append('-f')
+        cmds.append(strip_hdfs_prefix(src) if flag_src_hdfs else src)
+        cmds.append(strip_hdfs_prefix(dest) if flag_dest_hdfs else dest)
+        log.debug(cmds)
+        check_call(cmds)
+
+    def copy_into(self, srcs, dest_dir, force=True):
+        """Copy several files into a directory on HDFS, keeping their basenames."""
+        # hadoop needs a different command for sources on HDFS vs local ones
+        hdfs_srcs = [strip_hdfs_prefix(s) for s in srcs if is_hdfs_path(s)]
+        local_srcs = [s for s in srcs if not is_hdfs_path(s)]
+        for hadoop_cmd, sources in [('-cp', hdfs_srcs), ('-copyFromLocal', local_srcs)]:
+            if not sources:
+                continue
+            cmds = ['hadoop', 'fs', hadoop_cmd]
+            if force:
+                cmds.append('-f')
+            cmds.extend(sources)
+            cmds.append(strip_hdfs_prefix(dest_dir))
+            log.debug(cmds)
+            check_call(cmds)
+
+
+def _import_http():
+    """Import the HTTP & URL functions used by WebHDFSBackend.
+
+    These are slow to import, so they are only imported when a
+    WebHDFSBackend is made, rather than with the rest of the package.
+
+    Returns
+    -------
+    HTTPConnection, HTTPException, quote, urlencode, urlparse
+    """
+    try:  # Python 3
+        from http.client import HTTPConnection, HTTPException
+        from urllib.parse import quote, urlencode, urlparse
+    except ImportError:  # Python 2
+        from httplib import HTTPConnection, HTTPException
+        from urllib import quote, urlencode
+        from urlparse import urlparse
+    return HTTPConnection, HTTPException, quote, urlencode, urlparse
+
+
+class WebHDFSBackend(object):
+    """Filesystem backend for HDFS that uses the WebHDFS REST API.
+
+    This avoids starting a hadoop process for every operation. Each thread
+    keeps one open connection to the namenode, and to each datanode,
+    which is reused for all operations.
+
+    All paths are full filepaths, /hdfs/...
+
+    Parameters
+    ----------
+    url : str
+        URL of namenode HTTP server, e.g. http://namenode.example.com:50070
+
+    user : str, optional
+        Username to perform operations as. Defaults to $LOGNAME.
+
+    timeout : int, optional
+        Timeout for each request, in seconds.
+    """
+
+    def __init__(self, url, user=None, timeout=300):
+        super(WebHDFSBackend, self).__init__()
+        (self._connection_class, self._http_exception, self._quote, self._urlencode,
+         self._urlparse) = _import_http()
+        self.netloc = self._urlparse(url).netloc
+        self.user = user or os.environ.get('LOGNAME')
+        self.timeout = timeout
+        # Hold connections separately for each thread, since they cannot be shared
+        self._local = threading.local()
+
+    def _get_connection(self, netloc):
+        """Get an open connection to a host, making it if necessary."""
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        if netloc not in self._local.connections:
+            self._local.connections[netloc] = self._connection_class(netloc,
+                                                                     timeout=self.timeout)
+        return self._local.connections[netloc]
+
+    def _request(self, method, url, body=None, out_file=None):
+        """Make a request, returning the response status, headers, and body.
+
+        If `out_file` is set, a successful response body is written to it
+        instead of being returned. If the connection has been dropped since it
+        was last used, or drops while the body is being written to
+        `out_file`, it is reopened and the request retried once. `out_file`
+        is emptied first, so a partial first copy is not kept.
+        """
+        url_parts = self._urlparse(url)
+        netloc = url_parts.netloc or self.netloc
+        path = url_parts.path + ('?' + url_parts.query if url_parts.query else '')
+        request_headers = {}
+        if hasattr(body, 'seek'):
+            # Python 3 would otherwise send file objects chunked. Seek rather
+            # than stat, as the file may have unflushed writes.
+            body.seek(0, os.SEEK_END)
+            request_headers['Content-Length'] = str(body.tell())
+        for attempt in range(2):
+            conn = self._get_connection(netloc)
+            try:
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+                conn.request(method, path, body, request_headers)
+                resp = conn.getresponse()
+                # header names are lowercase on Python 2, but not 3
+                headers = dict((k.lower(), v) for k, v in resp.getheaders())
+                if out_file and resp.status == 200:
+                    out_file.seek(0)
+                    out_file.truncate()
+                    shutil.copyfileobj(resp, out_file)
+                    # A dropped connection just ends the body early, without an error
+                    expected_length = headers.get('content-length')
+                    if expected_length is not None and out_file.tell() != int(expected_length):
+                        raise self._http_exception('Got %d of %s bytes' %
+                                                   (out_file.tell(), expected_length))
+                    return resp.status, headers, ''
+                return resp.status, headers, resp.read().decode('utf-8')
+            except (self._http_exception, socket.error):
+                conn.close()
+                del self._local.connections[netloc]
+                if attempt == 1:
+                    raise
+
+    def _operation(self, method, path, op, body=None, out_file=None, expected=(200,), **params):
+        """Run a WebHDFS operation on a path, following any redirect to a datanode.
+
+        `body` is data (str or file object) to send, and `out_file` is a file
+        object to write any returned data to.
+
+        Returns
+        -------
+        int, str
+            HTTP status code, and response body.
+
+        Raises
+        ------
+        IOError
+            If the response status is not one of `expected`.
+        """
+        params.update(op=op)
+        if self.user:
+            params['user.name'] = self.user
+        query = self._urlencode(sorted(params.items()))
+        url = '/webhdfs/v1' + self._quote(strip_hdfs_prefix(path)) + '?' + query
+        # Data is sent to the datanode the namenode redirects us to,
+        # so do not send it to the namenode.
+        status, headers, data = self._request(method, url)
+        if status == 307:
+            status, headers, data = self._request(method, headers['location'], body, out_file)
+        if status not in expected:
+            raise IOError('WebHDFS %s %s failed with status %d: %s' % (op, path, status, data))
+        return status, data
+
+    def exists(self, path):
+        status, _ = self._operation('GET', path, 'GETFILESTATUS', expected=(200, 404))
+        return status == 200
+
+    def isdir(self, path):
+        status, data = self._operation('GET', path, 'GETFILESTATUS', expected=(200, 404))
+        return status == 200 and json.loads(data)['FileStatus']['type'] == 'DIRECTORY'
+
+    def listdir(self, path):
+        _, data = self._operation('GET', path, 'LISTSTATUS')
+        return [f['pathSuffix'] for f in json.loads(data)['FileStatuses']['FileStatus']]
+
+    def list_status(self, path):
+        """Get {name: (is directory, size in bytes)} for a directory's contents."""
+        _, data = self._operation('GET', path, 'LISTSTATUS')
+        return dict((f['pathSuffix'], (f['type'] == 'DIRECTORY', f['length']))
+                    for f in json.loads(data)['FileStatuses']['FileStatus'])
+
+    def mkdirs(self, paths):
+        """Make directories, including any parents."""
+        for path in paths:
+            self._operation('PUT', path, 'MKDIRS')
+
+    def copy(self, src, dest, force=True):
+        """Copy a file or directory, where one or both of `src` and `dest` are
+        on HDFS. Directories are copied one file at a time."""
+        src_isdir = self.isdir(src) if is_hdfs_path(src) else os.path.isdir(src)
+        self._copy(src, dest, src_isdir, force)
+
+    def _copy(self, src, dest, src_isdir, force):
+        """Copy a file or directory, given whether `src` is a directory."""
+        if src_isdir:
+            if is_hdfs_path(dest):
+                self.mkdirs([dest])
+            elif not os.path.isdir(dest):
+                os.makedirs(dest)
+            status = self.list_status(src) if is_hdfs_path(src) else _list_local_status(src)
+            for name, (isdir, _) in sorted(status.items()):
+                self._copy(os.path.join(src, name), os.path.join(dest, name), isdir, force)
+            return
+        overwrite = str(bool(force)).lower()
+        if not is_hdfs_path(src):
+            with open(src, 'rb') as f:
+                self._operation('PUT', dest, 'CREATE', body=f, expected=(201,), overwrite=overwrite)
+        elif not is_hdfs_path(dest):
+            if os.path.exists(dest) and not force:
+                raise IOError('%s already exists' % dest)
+            with open(dest, 'wb') as f:
+                self._operation('GET', src, 'OPEN', out_file=f)
+        else:
+            # go via a local temporary file, to avoid holding it all in memory
+            tmp_file = tempfile.TemporaryFile()
+            try:
+                self._operation('GET', src, 'OPEN', out_file=tmp_file)
+                self._operation('PUT', dest, 'CREATE', body=tmp_file, expected=(201,),
+                                overwrite=overwrite)
+            finally:
+                tmp_file.close()
+
+    def copy_into(self, srcs, dest_dir, force=True):
+        """Copy several files into a directory on HDFS, keeping their basenames."""
+        for src in srcs:
+            self.copy(src, os.path.join(dest_dir, os.path.basename(src)), force)
+
+
+class LocalBackend(object):
+    """Filesystem backend that stores 'HDFS' files in a local directory.
+
+    /hdfs/A/B.txt is stored as `root_dir`/A/B.txt. Useful for testing
+    without HDFS access.
+
+    Parameters
+    ----------
+    root_dir : str
+        Local directory to act as the root of HDFS.
+    """
+
+    def __init__(self, root_dir):
+        super(LocalBackend, self).__init__()
+        self.root_dir = os.path.abspath(root_dir)
+
+    def local_path(self, path):
+        """Convert a /hdfs/... path into its path under self.root_dir"""
+        if not is_hdfs_path(path):
+            return path
+        return self.root_dir + strip_hdfs_prefix(path)
+
+    def exists(self, path):
+        return os.path.exists(self.local_path(path))
+
+    def isdir(self, path):
+        return os.path.isdir(self.local_path(path))
+
+    def listdir(self, path):
+        return os.listdir(self.local_path(path))
+
+    def list_status(self, path):
+        """Get {name: (is directory, size in bytes)} for a directory's contents."""
+        return _list_local_status(self.local_path(path))
+
+    def mkdirs(self, paths):
+        """Make directories, including any parents."""
+        for path in paths:
+            if not self.isdir(path):
+                os.makedirs(self.local_path(path))
+
+    def copy(self, src, dest, force=True):
+        """Copy a file or directory, where one or both of `src` and `dest` are on HDFS."""
+        src, dest = self.local_path(src), self.local_path(dest)
+        if os.path.exists(dest) and not force:
+            raise IOError('%s already exists' % dest)
+        if not os.path.isdir(src):
+            shutil.copy2(src, dest)
+            return
+        if os.path.isdir(dest):
+            shutil.rmtree(dest)
+        shutil.copytree(src, dest)
+
+    def copy_into(self, srcs, dest_dir, force=True):
+        """Copy several files into a directory on HDFS, keeping their basenames."""
+        for src in srcs:
+            self.copy(src, os.path.join(dest_dir, os.path.basename(src)), force)
+
+
+# Backend used for all operations on HDFS. See set_hdfs_backend().
+_HDFS_BACKEND = HadoopCLIBackend()
+
+
+def get_hdfs_backend():
+    """Get the filesystem backend used for operations on HDFS."""
+    return _HDFS_BACKEND
+
+
+def set_hdfs_backend(backend):
+    """Set the filesystem backend used for operations on HDFS.
+
+    Parameters
+    ----------
+    backend : HadoopCLIBackend, WebHDFSBackend, or LocalBackend
+        Backend object. Can be any object with the same methods.
+    """
+    global _HDFS_BACKEND
+    _HDFS_BACKEND = backend
+
+
+def list_dir(directory):
+    """List the contents of a directory, which may be on HDFS.
+
+    Parameters
+    ----------
+    directory : str
+        Name of directory to list.
+
+    Returns
+    -------
+    list[str]
+        Names of directory contents. Empty if `directory` does not exist.
+    """
+    if is_hdfs_path(directory):
+        backend = get_hdfs_backend()
+        return backend.listdir(directory) if backend.isdir(directory) else []
+    return os.listdir(directory) if os.path.isdir(directory) else []
+
+
+def list_dir_status(directory):
+    """Get the type & size of each item in a directory, which may be on HDFS.
+
+    Parameters
+    ----------
+    directory : str
+        Name of directory to list.
+
+    Returns
+    -------
+    dict
+        {name: (is directory, size in bytes)}. Empty if `directory` does not exist.
+    """
+    if is_hdfs_path(directory):
+        backend = get_hdfs_backend()
+        return backend.list_status(directory) if backend.isdir(directory) else {}
+    return _list_local_status(directory) if os.path.isdir(directory) else {}
+
+
 def check_dir_create(directory):
     """Check to see if directory exists, if not create it.
 
@@ -42,18 +583,115 @@ def check_dir_create(directory):
     IOError
         If 'directory' already exists but is a file.
     """
-    if not os.path.isdir(directory):
-        if os.path.abspath(directory).startswith('/hdfs'):
-            check_call(['hadoop', 'fs', '-mkdir', '-p', os.path.abspath(directory).replace('/hdfs', '')])
+    check_dirs_create([directory])
+
+
+def check_dirs_create(directories):
+    """Check to see if directories exist, and create any that do not.
+
+    Directories that this process has already created or found to exist are
+    not checked again. Where the parent of a directory is known to exist,
+    the parent is listed once, rather than checking each of its
+    subdirectories separately. All HDFS directories that need creating are
+    passed to the HDFS backend at once, so only one hadoop command is needed.
+
+    Parameters
+    ----------
+    directories : iterable[str]
+        Names of directories to check and create.
+
+    Raises
+    -------
+    IOError
+        If any of 'directories' already exists but is a file.
+    """
+    unknown = OrderedDict((os.path.abspath(d), None) for d in directories
+                          if os.path.abspath(d) not in _KNOWN_DIRS)
+    if not unknown:
+        return
+
+    backend = get_hdfs_backend()
+    parent_contents = {}
+    missing_hdfs = []
+    for directory in unknown:
+        parent, basename = os.path.split(directory)
+        if parent in _KNOWN_DIRS:
+            if parent not in parent_contents:
+                parent_contents[parent] = list_dir_status(parent)
+            status = parent_contents[parent].get(basename)
+            exists = status is not None
+            is_dir = exists and status[0]
+        elif is_hdfs_path(directory):
+            is_dir = backend.isdir(directory)
+            exists = is_dir or backend.exists(directory)
+        else:
+            is_dir = os.path.isdir(directory)
+            exists = is_dir or os.path.exists(directory)
+
+        if exists and not is_dir:
+            raise IOError('%s already exists but is a file' % directory)
+        elif exists:
+            pass
+        elif is_hdfs_path(directory):
+            missing_hdfs.append(directory)
         else:
             os.makedirs(directory)
 
+    if missing_hdfs:
+        # mkdir -p on a directory also makes its parents,
+        # so there is no need to also pass the parents
+        missing_parents = set()
+        for directory in missing_hdfs:
+            missing_parents.update(_get_parent_dirs(directory))
+        backend.mkdirs([d for d in missing_hdfs if d not in missing_parents])
+
+    for directory in unknown:
+        _KNOWN_DIRS.add(directory)
+        _KNOWN_DIRS.update(_get_parent_dirs(directory))
+
+
+def write_file_parts(filename, parts):
+    """Write strings to a file, via a temporary file that is renamed once
+    all of `parts` have been written.
+
+    If generating the parts raises an error, any existing file is left
+    unchanged, rather than being left truncated.
+
+    Parameters
+    ----------
+    filename : str
+        Filepath to write to.
+
+    parts : iterable[str]
+        Strings to write, in order.
+    """
+    tmp_filename = filename + '.tmp'
+    try:
+        with open(tmp_filename, 'w') as tmp_file:
+            for part in parts:
+                tmp_file.write(part)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+    os.rename(tmp_filename, filename)
+
+
+def _get_parent_dirs(directory):
+    """Get all parent directories of an absolute path, excluding the root."""
+    parents = []
+    parent = os.path.dirname(directory)
+    while parent != os.path.dirname(parent):
+        parents.append(parent)
+        parent = os.path.dirname(parent)
+    return parents
+
 
 def cp_hdfs(src, dest, force=True):
     """Copy file between src and destination, allowing for one or both to
     be on HDFS.
 
-    Uses the hadoop commands if possible to ensure safe transfer.
+    Uses the HDFS backend if possible to ensure safe transfer.
+    See set_hdfs_backend().
 
     Parameters
     ----------
@@ -67,26 +705,8 @@ def cp_hdfs(src, dest, force=True):
         If True, will overwrite destination file if it already exists.
     """
     # Check if source and/or destination reside on HDFS
-    flag_src_hdfs = src.startswith("/hdfs")
-    flag_dest_hdfs = dest.startswith("/hdfs")
-
-    if flag_src_hdfs or flag_dest_hdfs:
-        # Create HDFS-compatible paths
-        src_hdfs = src.replace("/hdfs", "") if flag_src_hdfs else src
-        dest_hdfs = dest.replace("/hdfs", "") if flag_dest_hdfs else dest
-
-        # use hadoop command
-        hadoop_cmd = '-cp'
-        if not flag_dest_hdfs:
-            hadoop_cmd = '-copyToLocal'
-        elif not flag_src_hdfs:
-            hadoop_cmd = '-copyFromLocal'
-        cmds = ['hadoop', 'fs', hadoop_cmd]
-        if force:
-            cmds.append('-f')
-        cmds.extend([src_hdfs, dest_hdfs])
-        log.debug(cmds)
-        check_call(cmds)
+    if is_hdfs_path(src) or is_hdfs_path(dest):
+        get_hdfs_backend().copy(src, dest, force)
     else:
         # use normal copy command
         if os.path.isfile(src):
@@ -95,6 +715,66 @@ def cp_hdfs(src, dest, force=True):
             shutil.copytree(src, dest)
 
 
+def cp_hdfs_batch(srcs, dest_dir, force=True):
+    """Copy several files into one destination directory, allowing for the
+    sources and/or destination to be on HDFS.
+
+    If the destination is on HDFS, all the sources are passed to the HDFS
+    backend at once. For the hadoop command line tools, this means the
+    start-up cost of hadoop is only paid once, not once per file.
+    Each file keeps its basename in the destination directory.
+
+    Parameters
+    ----------
+    srcs : list[str]
+        Source filepaths. For files on HDFS, use the full filepath, /hdfs/...
+
+    dest_dir : str
+        Destination directory. For HDFS, use the full filepath, /hdfs/...
+
+    force : bool, optional
+        If True, will overwrite destination files if they already exist.
+    """
+    if is_hdfs_path(dest_dir):
+        get_hdfs_backend().copy_into(srcs, dest_dir, force)
+    else:
+        for src in srcs:
+            cp_hdfs(src, os.path.join(dest_dir, os.path.basename(src)), force)
+
+
+def file_hash(filename, chunk_size=1024 * 1024):
+    """Get the SHA1 hash of a file's contents.
+
+    Hashes are cached, and only recalculated if the file's size or
+    modification time has changed since it was last hashed.
+
+    Parameters
+    ----------
+    filename : str
+        Filepath of file to hash.
+
+    chunk_size : int, optional
+        Number of bytes to read at a time.
+
+    Returns
+    -------
+    str
+        Hex digest of the file's contents.
+    """
+    realpath = os.path.realpath(filename)
+    stat = os.stat(realpath)
+    cached = _FILE_HASH_CACHE.get(realpath)
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime):
+        return cached[2]
+    sha = hashlib.sha1()
+    with open(realpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    _FILE_HASH_CACHE[realpath] = (stat.st_size, stat.st_mtime, digest)
+    return digest
+
+
 def date_time_now(fmt='%H:%M:%S %d %B %Y'):
     """Get current date and time as a string.
 
@@ -153,7 +833,7 @@ def check_certificate():
         If certificate valid but has < 1 hour remaining.
     """
     # use Popen and not check_output as doesn't exist in py2.6
-    proc = Popen(['voms-proxy-info'], stdout=PIPE, stderr=PIPE)
+    proc = Popen(['voms-proxy-info'], stdout=PIPE, stderr=PIPE, universal_newlines=True)
     out, err = proc.communicate()
     if err == '':
         parts = [line.split(':', 1) for line in out.split('\n') if line]
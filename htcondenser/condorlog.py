@@ -0,0 +1,505 @@
+"""
+Functions/classes to read HTCondor job event logs and condor_worker.py reports,
+and summarise the performance of many jobs.
+"""
+
+
+import fnmatch
+import json
+import logging
+import os
+import re
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+from multiprocessing import Pool
+
+
+log = logging.getLogger(__name__)
+
+
+# Event codes in HTCondor job event logs
+SUBMIT = 0
+EXECUTE = 1
+EVICTED = 4
+TERMINATED = 5
+IMAGE_SIZE = 6
+ABORTED = 9
+HELD = 12
+
+# Header line of each event, e.g. 001 (1234.005.000) 10/16 19:44:00 Job executing on host: ...
+EVENT_HEADER_RE = re.compile(r'^(\d{3}) \((\d+)\.(\d+)\.\d+\) (\S+) (\S+)')
+RETURN_VALUE_RE = re.compile(r'\(1\) Normal termination \(return value (-?\d+)\)')
+SIGNAL_RE = re.compile(r'\(0\) Abnormal termination \(signal (\d+)\)')
+# e.g. "   Memory (MB)          :        1       100      2048"
+RESOURCE_RE = re.compile(r'^\s*(Cpus|Disk \(KB\)|Memory \(MB\))\s*:\s*(.*)$')
+MEMORY_USAGE_RE = re.compile(r'^\s*(\d+)\s+-\s+MemoryUsage of job \(MB\)')
+
+# Report files from condor_worker.py
+REPORT_SUFFIX = '.report.json'
+
+# Quantities summarised for each group of jobs, with their units
+METRICS = OrderedDict([
+    ('queue_wait', 's'),
+    ('runtime', 's'),
+    ('stage_in', 's'),
+    ('execution', 's'),
+    ('stage_out', 's'),
+    ('memory', 'MB'),
+    ('memory_request', 'MB'),
+    ('max_rss', 'MB'),
+    ('disk', 'KB'),
+    ('disk_request', 'KB'),
+])
+
+
+def parse_event_time(date_str, time_str, year):
+    """Convert the date & time from an event header to seconds since the epoch.
+
+    Handles both the old format (MM/DD HH:MM:SS, with no year) and the ISO
+    format (YYYY-MM-DD HH:MM:SS).
+
+    Parameters
+    ----------
+    date_str, time_str : str
+        Date & time tokens from header.
+
+    year : int
+        Year to use if the date has none.
+
+    Returns
+    -------
+    float
+    """
+    if 'T' in date_str:
+        date_str, time_str = date_str.split('T', 1)
+    time_str = time_str[:8]
+    if '/' in date_str:
+        date_str = '%d/%s' % (year, date_str)
+        fmt = '%Y/%m/%d %H:%M:%S'
+    else:
+        fmt = '%Y-%m-%d %H:%M:%S'
+    return time.mktime(datetime.strptime(date_str + ' ' + time_str, fmt).timetuple())
+
+
+class LogEvent(object):
+    """One event from an HTCondor job event log.
+
+    Parameters
+    ----------
+    code : int
+        Event type, e.g. TERMINATED.
+
+    job_id : str
+        cluster.process of the job.
+
+    timestamp : float
+        Time of event, in seconds since the epoch.
+
+    lines : list[str]
+        Lines of the event after the header.
+    """
+
+    __slots__ = ('code', 'job_id', 'timestamp', 'lines')
+
+    def __init__(self, code, job_id, timestamp, lines):
+        self.code = code
+        self.job_id = job_id
+        self.timestamp = timestamp
+        self.lines = lines
+
+    def __repr__(self):
+        return 'LogEvent(code=%03d, job_id=%s, timestamp=%s)' % (
+            self.code, self.job_id, self.timestamp)
+
+
+def iter_events(filename):
+    """Read events from an HTCondor job event log one at a time.
+
+    Parameters
+    ----------
+    filename : str
+
+    Yields
+    ------
+    LogEvent
+    """
+    # Old-style dates have no year, so assume they are from the year the file
+    # was last modified
+    year = datetime.fromtimestamp(os.path.getmtime(filename)).year
+    header, lines = None, []
+    with open(filename) as log_file:
+        for line in log_file:
+            if line.startswith('...'):
+                if header:
+                    yield LogEvent(int(header.group(1)),
+                                   '%s.%s' % (header.group(2), int(header.group(3))),
+                                   parse_event_time(header.group(4), header.group(5), year),
+                                   lines)
+                header, lines = None, []
+            elif header is None:
+                header = EVENT_HEADER_RE.match(line)
+            else:
+                lines.append(line)
+
+
+def _max(current, value):
+    """max() where the current value may be None."""
+    return value if current is None else max(current, value)
+
+
+class JobSummary(object):
+    """Summary of one job, from its log events and condor_worker.py report.
+
+    Times are in seconds since the epoch, durations in seconds, and None
+    if unknown.
+    """
+
+    __slots__ = ('job_id', 'submit_time', 'first_execute_time', 'execute_time', 'end_time',
+                 'exit_code', 'n_evictions', 'n_holds', 'aborted', 'memory', 'memory_request',
+                 'disk', 'disk_request', 'stage_in', 'execution', 'stage_out', 'max_rss')
+
+    def __init__(self, job_id):
+        for attr in self.__slots__:
+            setattr(self, attr, None)
+        self.job_id = job_id
+        self.n_evictions = 0
+        self.n_holds = 0
+        self.aborted = False
+
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
+
+    def __repr__(self):
+        return 'JobSummary(%s)' % ', '.join('%s=%s' % (attr, getattr(self, attr))
+                                            for attr in self.__slots__)
+
+    def add_event(self, event):
+        """Update the summary with a LogEvent for this job."""
+        if event.code == SUBMIT:
+            self.submit_time = event.timestamp
+        elif event.code == EXECUTE:
+            # Jobs that are evicted start more than once: queue wait is until
+            # the first start, runtime is from the last start
+            if self.first_execute_time is None:
+                self.first_execute_time = event.timestamp
+            self.execute_time = event.timestamp
+        elif event.code == EVICTED:
+            self.n_evictions += 1
+        elif event.code == HELD:
+            self.n_holds += 1
+        elif event.code == ABORTED:
+            self.aborted = True
+            self.end_time = event.timestamp
+        elif event.code == IMAGE_SIZE:
+            for line in event.lines:
+                match = MEMORY_USAGE_RE.match(line)
+                if match:
+                    self.memory = _max(self.memory, int(match.group(1)))
+        elif event.code == TERMINATED:
+            self.end_time = event.timestamp
+            for line in event.lines:
+                match = RETURN_VALUE_RE.search(line)
+                if match:
+                    self.exit_code = int(match.group(1))
+                    continue
+                match = SIGNAL_RE.search(line)
+                if match:
+                    self.exit_code = -int(match.group(1))
+                    continue
+                match = RESOURCE_RE.match(line)
+                if match:
+                    self._add_resource(match.group(1), match.group(2).split())
+
+    def _add_resource(self, name, values):
+        """Add the usage & request from a line of the resource table in a
+        termination event. Usage may be missing."""
+        try:
+            values = [int(float(v)) for v in values]
+        except ValueError:
+            return
+        if len(values) < 2:
+            return
+        usage = values[0] if len(values) >= 3 else None
+        request = values[-2]
+        if name.startswith('Memory'):
+            self.memory_request = request
+            if usage is not None:
+                self.memory = _max(self.memory, usage)
+        elif name.startswith('Disk'):
+            self.disk_request = request
+            if usage is not None:
+                self.disk = _max(self.disk, usage)
+
+    def add_report(self, report):
+        """Update the summary with a condor_worker.py report dict (see load_report())."""
+        timings = report.get('timings', {})
+        self.stage_in = timings.get('stage_in')
+        self.execution = timings.get('execution')
+        self.stage_out = timings.get('stage_out')
+        max_rss_kb = report.get('exe_resources', {}).get('max_rss_kb')
+        if max_rss_kb is not None:
+            self.max_rss = max_rss_kb / 1024.
+        if self.exit_code is None:
+            self.exit_code = report.get('exit_code')
+
+    @property
+    def queue_wait(self):
+        """Time from submission to first starting execution."""
+        if self.submit_time is None or self.first_execute_time is None:
+            return None
+        return self.first_execute_time - self.submit_time
+
+    @property
+    def runtime(self):
+        """Time from (last) starting execution to finishing."""
+        if self.execute_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.execute_time
+
+    @property
+    def failed(self):
+        """Whether the job was aborted or exited with a non-zero code."""
+        return self.aborted or bool(self.exit_code)
+
+
+def parse_log_file(filename):
+    """Summarise all jobs in an HTCondor job event log.
+
+    Parameters
+    ----------
+    filename : str
+
+    Returns
+    -------
+    str, list[JobSummary]
+        The filename, and a summary for each job in the log.
+    """
+    jobs = OrderedDict()
+    try:
+        for event in iter_events(filename):
+            if event.job_id not in jobs:
+                jobs[event.job_id] = JobSummary(event.job_id)
+            jobs[event.job_id].add_event(event)
+    except (IOError, ValueError) as err:
+        log.warning('Could not read %s: %s', filename, err)
+    return filename, list(jobs.values())
+
+
+def load_report(filename):
+    """Load a condor_worker.py JSON report.
+
+    Only the fields used by JobSummary.add_report() are kept, since all
+    reports are held in memory while the logs are read, and the lists of
+    files copied can be large.
+
+    Returns
+    -------
+    str, dict
+        cluster.process of the job, and the report. (None, None) if the
+        file cannot be read.
+    """
+    try:
+        with open(filename) as report_file:
+            report = json.load(report_file)
+    except (IOError, ValueError) as err:
+        log.warning('Could not read %s: %s', filename, err)
+        return None, None
+    job_id = '%s.%s' % (report.get('cluster'), report.get('process'))
+    if report.get('cluster') is None:
+        # Fall back to the filename, <cluster>.<process>.report.json
+        job_id = os.path.basename(filename)[:-len(REPORT_SUFFIX)]
+    timings = report.get('timings') or {}
+    resources = report.get('exe_resources') or {}
+    return job_id, {'timings': dict((k, timings.get(k))
+                                    for k in ('stage_in', 'execution', 'stage_out')),
+                    'exe_resources': {'max_rss_kb': resources.get('max_rss_kb')},
+                    'exit_code': report.get('exit_code')}
+
+
+def iter_files(directory, patterns, exclude=None):
+    """Find files under a directory matching any of the patterns, lazily.
+
+    Parameters
+    ----------
+    directory : str
+
+    patterns : list[str]
+        Glob patterns for filenames, e.g. ['*.log'].
+
+    exclude : list[str], optional
+        Glob patterns for filenames to skip.
+
+    Yields
+    ------
+    str
+        Filepath.
+    """
+    exclude = exclude or []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if not any(fnmatch.fnmatch(filename, p) for p in patterns):
+                continue
+            if not any(fnmatch.fnmatch(filename, p) for p in exclude):
+                yield os.path.join(dirpath, filename)
+
+
+def percentile(sorted_values, fraction):
+    """Get a percentile from a sorted sequence, using the nearest rank.
+
+    Parameters
+    ----------
+    sorted_values : sequence[float]
+
+    fraction : float
+        Percentile as a fraction, e.g. 0.9
+
+    Returns
+    -------
+    float
+        None if there are no values.
+    """
+    if not len(sorted_values):
+        return None
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[min(max(index, 0), len(sorted_values) - 1)]
+
+
+class JobStats(object):
+    """Collect JobSummaries into groups, and summarise each group's
+    distribution of each metric (see METRICS).
+
+    Only the values of each metric are stored, compactly, not the summaries.
+
+    Parameters
+    ----------
+    percentiles : list[float], optional
+        Percentiles to calculate, as fractions.
+    """
+
+    def __init__(self, percentiles=(0.5, 0.9, 0.99)):
+        super(JobStats, self).__init__()
+        self.percentiles = list(percentiles)
+        # key is group name, value is dict of {metric: array of values}
+        self.values = OrderedDict()
+        # key is group name, value is dict of job counts
+        self.counts = OrderedDict()
+
+    def add(self, group, summary):
+        """Add a JobSummary to a group."""
+        if group not in self.values:
+            self.values[group] = OrderedDict((m, array('d')) for m in METRICS)
+            self.counts[group] = OrderedDict([('jobs', 0), ('failed', 0), ('evictions', 0),
+                                              ('holds', 0)])
+        counts = self.counts[group]
+        counts['jobs'] += 1
+        counts['failed'] += int(summary.failed)
+        counts['evictions'] += summary.n_evictions
+        counts['holds'] += summary.n_holds
+        for metric, values in self.values[group].items():
+            value = getattr(summary, metric)
+            if value is not None:
+                values.append(value)
+
+    def summarise(self):
+        """Get the distribution of each metric in each group.
+
+        Returns
+        -------
+        OrderedDict
+            {group: {'counts': {...}, 'metrics': {metric: {'n', 'mean', 'p50', ..., 'max'}}}}
+            Metrics with no values are left out.
+        """
+        result = OrderedDict()
+        for group, metrics in self.values.items():
+            group_result = OrderedDict([('counts', self.counts[group]),
+                                        ('metrics', OrderedDict())])
+            for metric, values in metrics.items():
+                if not values:
+                    continue
+                sorted_values = sorted(values)
+                stats = OrderedDict([('n', len(values)), ('mean', sum(values) / len(values))])
+                for fraction in self.percentiles:
+                    stats['p%g' % (100 * fraction)] = percentile(sorted_values, fraction)
+                stats['max'] = sorted_values[-1]
+                group_result['metrics'][metric] = stats
+            result[group] = group_result
+        return result
+
+
+def collect_job_stats(log_dir, report_dir=None, processes=None, percentiles=(0.5, 0.9, 0.99),
+                      log_patterns=('*.log',), group_by=None, job_filter=None):
+    """Summarise all the jobs whose logs are under `log_dir`.
+
+    Log files are found and parsed lazily, on a pool of processes, so only
+    the summary of each job is kept in memory. Jobs are grouped by the
+    directory of their log file. JobSets share the same log_dir by default,
+    so give each one its own log_dir to summarise them separately.
+
+    Parameters
+    ----------
+    log_dir : str
+        Directory to search for HTCondor job event logs.
+
+    report_dir : str, optional
+        Directory to search for condor_worker.py reports (*.report.json),
+        which are matched to jobs by cluster & process IDs.
+
+    processes : int, optional
+        Number of processes to parse files with. Defaults to number of CPUs.
+
+    percentiles : list[float], optional
+        Percentiles to calculate, as fractions.
+
+    log_patterns : list[str], optional
+        Glob patterns for log filenames.
+
+    group_by : callable, optional
+        Function that takes the log filename and returns the group name.
+        By default, the directory relative to `log_dir`.
+
+    job_filter : callable, optional
+        Function that takes a JobSummary and returns False to leave it out.
+
+    Returns
+    -------
+    JobStats
+    """
+    if group_by is None:
+        def group_by(filename):
+            return os.path.relpath(os.path.dirname(filename), log_dir)
+
+    pool = Pool(processes)
+    try:
+        reports = {}
+        if report_dir:
+            report_files = iter_files(report_dir, ['*' + REPORT_SUFFIX])
+            for job_id, report in pool.imap_unordered(load_report, report_files, chunksize=100):
+                if job_id:
+                    reports[job_id] = report
+            log.info('Read %d reports', len(reports))
+
+        stats = JobStats(percentiles)
+        # Skip DAGMan's own logs, since they repeat the events of its jobs
+        log_files = iter_files(log_dir, log_patterns, exclude=['*.nodes.log', '*.dagman.log'])
+        n_files = 0
+        for filename, summaries in pool.imap_unordered(parse_log_file, log_files, chunksize=100):
+            n_files += 1
+            group = group_by(filename)
+            for summary in summaries:
+                if job_filter and not job_filter(summary):
+                    continue
+                report = reports.get(summary.job_id)
+                if report:
+                    summary.add_report(report)
+                stats.add(group, summary)
+        log.info('Read %d log files', n_files)
+    finally:
+        pool.close()
+        pool.join()
+    return stats
@@ -4,12 +4,15 @@ DAGMan class to handle DAGs in HTCondor.
 
 
 import logging
+import numbers
 import os
 from copy import deepcopy
 from subprocess import check_call
-from collections import OrderedDict
 import htcondenser as ht
-from htcondenser.common import date_time_now, check_dir_create
+from htcondenser.common import (date_time_now, check_dir_create, write_file_parts,
+                                string_types)
+from htcondenser.graph import DAGGraph
+from htcondenser.staging import FileStager, TransferManifest
 
 
 log = logging.getLogger(__name__)
@@ -43,6 +46,11 @@ class DAGMan(object):
     JOB_VAR_NAME : str
         Name of variable to hold job arguments string to pass to condor_worker.py,
         required in both DAG file and condor submit file.
+
+    jobs : DAGGraph
+        Jobs in the DAG and their requirements, indexed by job name. Can be
+        used to query relationships, e.g. jobs.children(name), jobs.roots(),
+        jobs.topological_order().
     """
 
     # name of variable for individual condor submit files
@@ -63,22 +71,34 @@ class DAGMan(object):
         self.dot = dot
         self.other_args = other_args
 
-        # hold info about Jobs. key is name, value is a dict
-        self.jobs = OrderedDict()
+        # hold info about Jobs and their requirements. key is name, value is a DAGNode
+        self.jobs = DAGGraph()
+        # Version of self.jobs that was last checked for cycles
+        self._checked_acyclic_version = None
 
     def __getitem__(self, i):
-        if isinstance(i, int):
-            if i >= len(self):
-                raise IndexError()
-            return self.jobs.values()[i]['job']
+        """Get Job(s) by position or slice, in the order they were added,
+        or by name."""
+        if isinstance(i, numbers.Integral):
+            return self.jobs.node_at(i).job
         elif isinstance(i, slice):
-            return [x['job'] for x in self.jobs.values()[i]]
+            return [x.job for x in self.jobs.node_at(i)]
+        elif isinstance(i, string_types):
+            return self.jobs[i].job
         else:
-            raise TypeError('Invalid argument type - must be int or slice')
+            raise TypeError('Invalid argument type - must be int, slice or str')
 
     def __len__(self):
         return len(self.jobs)
 
+    def __iter__(self):
+        """Iterate over Jobs, in the order they were added."""
+        return (node.job for node in self.jobs.nodes())
+
+    def __contains__(self, job):
+        """Check if a Job, or a job name, is in this DAG."""
+        return getattr(job, 'name', job) in self.jobs
+
     def add_job(self, job, requires=None, job_vars=None, retry=None):
         """Add a Job to the DAG.
 
@@ -116,12 +136,6 @@ class DAGMan(object):
         if job.name in self.jobs:
             raise KeyError('Job with name %s already exists in DAG - names must be unique' % job.name)
 
-        # Append necessary job arguments to any user opts.
-        job_vars = job_vars or ""
-        job_vars += 'jobOpts="%s"' % job.generate_job_arg_str()
-
-        self.jobs[job.name] = dict(job=job, job_vars=job_vars, retry=retry, requires=None)
-
         hierarchy_list = []
         # requires can be:
         # - a job name [str]
@@ -129,13 +143,13 @@ class DAGMan(object):
         # - a Job [Job]
         # - a list/tuple/set of Jobs [list(Job)]
         if requires:
-            if isinstance(requires, str):
+            if isinstance(requires, string_types):
                 hierarchy_list.append(requires)
             elif isinstance(requires, ht.Job):
                 hierarchy_list.append(requires.name)
             elif hasattr(requires, '__getitem__'):  # maybe getattr better?
                 for it in requires:
-                    if isinstance(it, str):
+                    if isinstance(it, string_types):
                         hierarchy_list.append(it)
                     elif isinstance(it, ht.Job):
                         hierarchy_list.append(it.name)
@@ -144,8 +158,121 @@ class DAGMan(object):
             else:
                 raise TypeError('Can only add Job(s) or job name(s)')
 
-        # Keep list of names of Jobs that must be executed before this one.
-        self.jobs[job.name]['requires'] = hierarchy_list
+        self.jobs.add_node(job.name, job=job, job_vars=job_vars, retry=retry)
+        # Store names of Jobs that must be executed before this one.
+        for parent in hierarchy_list:
+            self.jobs.add_edge(parent, job.name)
+
+    def add_jobs(self, jobs, job_vars=None, retry=None):
+        """Add many Jobs to the DAG in one go.
+
+        All jobs are checked before any are added, so if any job is invalid,
+        the DAG is left unchanged. Dependencies between jobs can be added
+        afterwards with add_dependencies(), add_fan_in() or add_fan_out().
+
+        Parameters
+        ----------
+        jobs : iterable[Job]
+            Job objects to be added to DAG.
+
+        job_vars : str, optional
+            String of job variables specifically for the DAG, used for all jobs.
+            Note that program arguments should be set in Job.args not here.
+
+        retry : int or str, optional
+            Number of retry attempts for each job.
+
+        Raises
+        ------
+        KeyError
+            If a Job with the same name has already been added to the DAG,
+            or appears twice in `jobs`.
+
+        TypeError
+            If any item in `jobs` is not of type Job.
+        """
+        jobs = list(jobs)
+        names = set()
+        for job in jobs:
+            if not isinstance(job, ht.Job):
+                raise TypeError('Cannot added a non-Job object to DAGMan.')
+            if job.name in names or job.name in self.jobs:
+                raise KeyError('Job with name %s already exists in DAG - '
+                               'names must be unique' % job.name)
+            names.add(job.name)
+
+        for job in jobs:
+            self.jobs.add_node(job.name, job=job, job_vars=job_vars, retry=retry)
+
+    def add_dependencies(self, edges):
+        """Add many requirements between jobs in one go.
+
+        Jobs do not need to have been added to the DAG yet, but must be by the
+        time the DAG is written. All edges are checked before any are added.
+
+        Parameters
+        ----------
+        edges : iterable[(str or Job, str or Job)]
+            Pairs of (parent, child) Jobs or job names, where the parent must
+            run before the child can run.
+
+        Raises
+        ------
+        TypeError
+            If any item in `edges` is not a pair of Jobs or job names.
+        """
+        name_edges = []
+        for edge in edges:
+            try:
+                parent, child = edge
+            except (TypeError, ValueError):
+                raise TypeError('Each dependency must be a (parent, child) pair')
+            name_edges.append((self._get_job_name(parent), self._get_job_name(child)))
+
+        for parent, child in name_edges:
+            self.jobs.add_edge(parent, child)
+
+    def add_fan_in(self, parents, child):
+        """Add requirements such that `child` can only run after all `parents`.
+
+        Parameters
+        ----------
+        parents : iterable[str or Job]
+            Jobs or job names that must run first.
+
+        child : str or Job
+            Job or job name that requires all the parents.
+        """
+        self.add_dependencies((parent, child) for parent in parents)
+
+    def add_fan_out(self, parent, children):
+        """Add requirements such that all `children` can only run after `parent`.
+
+        Parameters
+        ----------
+        parent : str or Job
+            Job or job name that must run first.
+
+        children : iterable[str or Job]
+            Jobs or job names that require the parent.
+        """
+        self.add_dependencies((parent, child) for child in children)
+
+    @staticmethod
+    def _get_job_name(job):
+        """Get the name of a Job, or check a job name is a str.
+
+        Raises
+        ------
+        TypeError
+            If `job` argument is not of type str or Job.
+        """
+        if isinstance(job, ht.Job):
+            return job.name
+        elif isinstance(job, string_types):
+            return job
+        log.debug(type(job))
+        raise TypeError('job argument must be job name or Job object.')
 
     def check_job_requirements(self, job):
         """Check that the required Jobs actually exist and have been added to DAG.
@@ -164,25 +291,16 @@ class DAGMan(object):
             If `job` argument is not of type str or Job, or an iterable of
             strings or Jobs.
         """
-        job_name = ''
-        if isinstance(job, ht.Job):
-            job_name = job.name
-        elif isinstance(job, str):
-            job_name = job
-        else:
-            log.debug(type(job))
-            raise TypeError('job argument must be job name or Job object.')
-        req_jobs = set(self.jobs[job_name]['requires'])
-        all_jobs = set(self.jobs)
-        if not req_jobs.issubset(all_jobs):
+        job_name = self._get_job_name(job)
+        missing = [r for r in self.jobs.parents(job_name) if r not in self.jobs]
+        if missing:
             raise KeyError('The following requirements on %s do not have corresponding '
-                           'Job objects: %s' % (job_name, ', '.join(list(req_jobs - all_jobs))))
+                           'Job objects: %s' % (job_name, ', '.join(missing)))
 
     def check_job_acyclic(self, job):
         """Check no circular requirements, e.g. A ->- B ->- A
 
-        Get all requirements for all parent jobs recursively, and check for
-        the presence of this job in that list.
+        This checks the whole DAG, see check_acyclic().
 
         Parameters
         ----------
@@ -194,19 +312,26 @@ class DAGMan(object):
         RuntimeError
             If job has circular dependency.
         """
-        job_name = job.name if isinstance(job, ht.Job) else job
-        parents = self.jobs[job_name]['requires']
-        log.debug('Checking %s', job_name)
-        log.debug(parents)
-        while parents:
-            new_parents = []
-            for p in parents:
-                grandparents = self.jobs[p]['requires']
-                if job_name in grandparents:
-                    raise RuntimeError("%s is in requirements for %s - cannot "
-                                       "have cyclic dependencies" % (job_name, p))
-                new_parents.extend(grandparents)
-                parents = new_parents[:]
+        return self.check_acyclic()
+
+    def check_acyclic(self):
+        """Check there are no circular requirements anywhere in the DAG.
+
+        Does a single depth-first search over all jobs, so takes time
+        proportional to the number of jobs + requirements. The result is
+        remembered until the DAG changes.
+
+        Raises
+        ------
+        RuntimeError
+            If the DAG has a circular dependency. The message includes the
+            jobs that form the cycle.
+        """
+        if self._checked_acyclic_version != self.jobs.version:
+            cycle = self.jobs.find_cycle()
+            if cycle:
+                raise RuntimeError('Cannot have cyclic dependencies: %s' % ' ->- '.join(cycle))
+            self._checked_acyclic_version = self.jobs.version
         return True
 
     def generate_job_str(self, job):
@@ -230,25 +355,19 @@ class DAGMan(object):
         TypeError
             If `job` argument is not of type str or Job.
         """
-        job_name = ''
-        if isinstance(job, ht.Job):
-            job_name = job.name
-        elif isinstance(job, str):
-            job_name = job
-        else:
-            log.debug(type(job))
-            raise TypeError('job argument must be job name or Job object.')
+        job_name = self._get_job_name(job)
 
-        job_obj = self.jobs[job_name]['job']
-        job_contents = ['JOB %s %s' % (job_name, job_obj.manager.filename)]
+        node = self.jobs[job_name]
+        job_contents = ['JOB %s %s' % (job_name, node.job.manager.filename)]
 
-        job_vars = self.jobs[job_name]['job_vars']
-        if job_vars:
-            job_contents.append('VARS %s %s' % (job_name, job_vars))
+        # Append necessary job arguments to any user opts.
+        # These are only generated here, so that adding jobs is quick.
+        job_vars = node.job_vars or ""
+        job_vars += '%s="%s"' % (self.JOB_VAR_NAME, node.job.generate_job_arg_str())
+        job_contents.append('VARS %s %s' % (job_name, job_vars))
 
-        job_retry = self.jobs[job_name]['retry']
-        if job_retry:
-            job_contents.append('RETRY %s %s' % (job_name, job_retry))
+        if node.retry:
+            job_contents.append('RETRY %s %s' % (job_name, node.retry))
 
         return '\n'.join(job_contents)
 
@@ -256,7 +375,8 @@ class DAGMan(object):
         """Generate a string of prerequisite jobs for this job.
 
         Does a check to make sure that the prerequisite Jobs do exist in the DAG,
-        and that DAG is acyclic.
+        and that DAG is acyclic. The acyclic check is only done once for the
+        whole DAG, not for every job.
 
         Parameters
         ----------
@@ -273,20 +393,14 @@ class DAGMan(object):
         TypeError
             If `job` argument is not of type str or Job.
         """
-        job_name = ''
-        if isinstance(job, ht.Job):
-            job_name = job.name
-        elif isinstance(job, str):
-            job_name = job
-        else:
-            log.debug(type(job))
-            raise TypeError('job argument must be job name or Job object.')
+        job_name = self._get_job_name(job)
 
         self.check_job_requirements(job)
-        self.check_job_acyclic(job)
+        self.check_acyclic()
 
-        if self.jobs[job_name]['requires']:
-            return 'PARENT %s CHILD %s' % (' '.join(self.jobs[job_name]['requires']), job_name)
+        parents = self.jobs.parents(job_name)
+        if parents:
+            return 'PARENT %s CHILD %s' % (' '.join(parents), job_name)
         else:
             return ''
 
@@ -299,39 +413,48 @@ class DAGMan(object):
         str:
             DAG file contents
         """
-        # Hold each line as entry in this list, then finally join with \n
-        contents = ['# DAG created at %s' % date_time_now(), '']
+        return '\n'.join(self.generate_dag_lines()) + '\n'
+
+    def generate_dag_lines(self):
+        """
+        Generate DAG file contents line by line, so that they can be written
+        out without holding the whole file in memory.
+
+        Yields
+        ------
+        str:
+            Line (or lines for one job) of the DAG file, without trailing newline.
+        """
+        yield '# DAG created at %s' % date_time_now()
+        yield ''
 
         # Add jobs
         for name in self.jobs:
-            contents.append(self.generate_job_str(name))
+            yield self.generate_job_str(name)
 
         # Add parent-child relationships
         for name in self.jobs:
             req_str = self.generate_job_requirements_str(name)
             if req_str != '':
-                contents.append(req_str)
+                yield req_str
 
         # Add other options for DAG
         if self.status_file:
-            contents.append('')
-            contents.append('NODE_STATUS_FILE %s %s' % (self.status_file, self.status_update_period))
+            yield ''
+            yield 'NODE_STATUS_FILE %s %s' % (self.status_file, self.status_update_period)
 
         if self.dot:
-            contents.append('')
-            contents.append('# Make a visual representation of this DAG (for PDF format):')
+            yield ''
+            yield '# Make a visual representation of this DAG (for PDF format):'
             fmt = 'pdf'
             output_file = os.path.splitext(self.dot)[0] + '.' + fmt
-            contents.append('# dot -T%s %s -o %s' % (fmt, self.dot, output_file))
-            contents.append('DOT %s' % self.dot)
+            yield '# dot -T%s %s -o %s' % (fmt, self.dot, output_file)
+            yield 'DOT %s' % self.dot
 
         if self.other_args:
-            contents.append('')
-            for k, v in self.other_args.iteritems():
-                contents.append('%s = %s' % (k, v))
-
-        contents.append('')
-        return '\n'.join(contents)
+            yield ''
+            for k, v in sorted(self.other_args.items()):
+                yield '%s = %s' % (k, v)
 
     def get_jobsets(self):
         """Get a list of all unique JobSets managing Jobs in this DAG.
@@ -341,21 +464,54 @@ class DAGMan(object):
         name : list
             List of unique JobSet objects.
         """
-        return list(set([jdict['job'].manager for jdict in self.jobs.itervalues()]))
+        return list(set([node.job.manager for node in self.jobs.nodes()]))
+
+    def transfer_to_hdfs(self, num_workers=4, batch_size=50, incremental=False):
+        """Copy any necessary input files for all JobSets to HDFS.
+
+        Files from all JobSets are copied together, so that batches can be
+        shared between JobSets that use the same directories on HDFS.
+
+        Parameters
+        ----------
+        num_workers : int, optional
+            Maximum number of copy commands to run concurrently.
+
+        batch_size : int, optional
+            Maximum number of files to copy with a single command.
+
+        incremental : bool, optional
+            If True, skip files that have not changed since they were last
+            copied, according to the manifest next to the DAG file.
+            See generate_manifest_filename().
+        """
+        manifest = TransferManifest(self.generate_manifest_filename()) if incremental else None
+        stager = FileStager(num_workers=num_workers, batch_size=batch_size, manifest=manifest)
+        for manager in self.get_jobsets():
+            stager.add_mirrors(manager.get_files_to_transfer())
+        stager.transfer()
 
     def write(self):
         """Write DAG to file and causes all Jobs to write their HTCondor submit files."""
-        dag_contents = self.generate_dag_contents()
         log.info('Writing DAG to %s', self.dag_filename)
         check_dir_create(os.path.dirname(os.path.realpath(self.dag_filename)))
-        with open(self.dag_filename, 'w') as dfile:
-            dfile.write(dag_contents)
+        write_file_parts(self.dag_filename, (line + '\n' for line in self.generate_dag_lines()))
 
         # Write job files for each JobSet
         for manager in self.get_jobsets():
             manager.write(dag_mode=True)
 
-    def submit(self, force=False, submit_per_interval=10):
+    def generate_manifest_filename(self):
+        """Get the filename of the manifest of files copied to HDFS.
+
+        Returns
+        -------
+        str
+            Filename, next to the DAG file.
+        """
+        return os.path.splitext(self.dag_filename)[0] + '.transfers.json'
+
+    def submit(self, force=False, submit_per_interval=10, incremental=True):
         """Write all necessary submit files, transfer files to HDFS, and submit DAG.
         Also prints out info for user.
 
@@ -365,6 +521,9 @@ class DAGMan(object):
             Force condor_submit_dag
         submit_per_interval : int, optional
             Number of DAGMan submissions per interval. The default 10 every 5 seconds.
+        incremental : bool, optional
+            If True, only copy files to HDFS that have changed since the last
+            submission. Otherwise all files are copied.
 
         Raises
         ------
@@ -372,8 +531,7 @@ class DAGMan(object):
             If condor_submit_dag returns non-zero exit code.
         """
         self.write()
-        for manager in self.get_jobsets():
-            manager.transfer_to_hdfs()
+        self.transfer_to_hdfs(incremental=incremental)
         cmds = ['condor_submit_dag', self.dag_filename]
         if force:
             cmds.insert(1, '-f')
@@ -0,0 +1,312 @@
+"""
+Classes to store the jobs in a DAG, and the dependencies between them.
+"""
+
+
+import logging
+from collections import deque
+
+
+log = logging.getLogger(__name__)
+
+
+class DAGNode(object):
+    """Hold info about one job in a DAG.
+
+    Parents and children are stored as integer IDs of other nodes in the
+    managing DAGGraph.
+
+    Parameters
+    ----------
+    name : str
+        Name of job.
+
+    job : Job, optional
+        Job object. None if the node has only been referenced as a requirement,
+        and not yet added.
+
+    job_vars : str, optional
+        String of job variables specifically for the DAG.
+
+    retry : int or str, optional
+        Number of retry attempts for this job.
+    """
+
+    __slots__ = ('name', 'job', 'job_vars', 'retry', 'parents', 'children')
+
+    def __init__(self, name, job=None, job_vars=None, retry=None):
+        self.name = name
+        self.job = job
+        self.job_vars = job_vars
+        self.retry = retry
+        self.parents = []
+        self.children = []
+
+    def __repr__(self):
+        return 'DAGNode(name=%s, job_vars=%s, retry=%s)' % (self.name, self.job_vars, self.retry)
+
+
+class DAGGraph(object):
+    """Directed graph of jobs, indexed by both parent and child.
+
+    Each job name is assigned an integer ID when first seen, either when the
+    job is added, or when it is first referenced as a requirement of another
+    job. This allows requirements to be specified before the required job
+    is added. Only added jobs count as being in the graph.
+
+    Methods that return related jobs take time proportional to the size of
+    their output.
+    """
+
+    def __init__(self):
+        super(DAGGraph, self).__init__()
+        self._ids = {}  # key is job name, value is ID
+        self._nodes = []  # DAGNode for each ID
+        self._order = []  # IDs of added jobs, in the order they were added
+        self._roots = set()  # IDs of added jobs with no parents
+        self._leaves = set()  # IDs of added jobs with no children
+        # Incremented every time the graph changes, so that results derived
+        # from it can be cached.
+        self.version = 0
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, name):
+        node_id = self._ids.get(name)
+        return node_id is not None and self._nodes[node_id].job is not None
+
+    def __iter__(self):
+        """Iterate over names of added jobs, in the order they were added."""
+        return (self._nodes[i].name for i in self._order)
+
+    def __getitem__(self, name):
+        """Get the DAGNode for an added job.
+
+        Raises
+        ------
+        KeyError
+            If no job with that name has been added.
+        """
+        if name not in self:
+            raise KeyError(name)
+        return self._nodes[self._ids[name]]
+
+    def _intern(self, name):
+        """Get the ID for a job name, creating a placeholder node if it is new."""
+        node_id = self._ids.get(name)
+        if node_id is None:
+            node_id = len(self._nodes)
+            self._ids[name] = node_id
+            self._nodes.append(DAGNode(name))
+        return node_id
+
+    def add_node(self, name, job, job_vars=None, retry=None):
+        """Add a job to the graph.
+
+        Parameters
+        ----------
+        name : str
+            Name of job.
+
+        job : Job
+            Job object.
+
+        job_vars : str, optional
+            String of job variables specifically for the DAG.
+
+        retry : int or str, optional
+            Number of retry attempts for this job.
+
+        Returns
+        -------
+        DAGNode
+            The node for this job.
+
+        Raises
+        ------
+        KeyError
+            If a job with that name has already been added.
+        """
+        if name in self:
+            raise KeyError('Job with name %s already exists in DAG - names must be unique' % name)
+        node_id = self._intern(name)
+        node = self._nodes[node_id]
+        node.job = job
+        node.job_vars = job_vars
+        node.retry = retry
+        self._order.append(node_id)
+        if not node.parents:
+            self._roots.add(node_id)
+        if not node.children:
+            self._leaves.add(node_id)
+        self.version += 1
+        return node
+
+    def add_edge(self, parent, child):
+        """Add a requirement that job `parent` must run before job `child`.
+
+        Either job may not have been added yet.
+
+        Parameters
+        ----------
+        parent : str
+            Name of parent job.
+
+        child : str
+            Name of child job.
+        """
+        parent_id = self._intern(parent)
+        child_id = self._intern(child)
+        parent_node, child_node = self._nodes[parent_id], self._nodes[child_id]
+        # Check for a duplicate in the shorter list, so that fan-in and
+        # fan-out to many jobs stay fast
+        if len(child_node.parents) <= len(parent_node.children):
+            if parent_id in child_node.parents:
+                return
+        elif child_id in parent_node.children:
+            return
+        child_node.parents.append(parent_id)
+        parent_node.children.append(child_id)
+        self._roots.discard(child_id)
+        self._leaves.discard(parent_id)
+        self.version += 1
+
+    def nodes(self):
+        """Iterate over DAGNodes of added jobs, in the order they were added."""
+        return (self._nodes[i] for i in self._order)
+
+    def node_at(self, index):
+        """Get the DAGNode(s) of the added job(s) at a position (or slice) in
+        the order they were added.
+
+        Parameters
+        ----------
+        index : int or slice
+
+        Returns
+        -------
+        DAGNode or list[DAGNode]
+        """
+        if isinstance(index, slice):
+            return [self._nodes[i] for i in self._order[index]]
+        return self._nodes[self._order[index]]
+
+    def _names(self, ids):
+        return [self._nodes[i].name for i in ids]
+
+    def parents(self, name):
+        """Get names of jobs that `name` requires, including any not yet added."""
+        return self._names(self._nodes[self._ids[name]].parents)
+
+    def children(self, name):
+        """Get names of jobs that require `name`, including any not yet added."""
+        return self._names(self._nodes[self._ids[name]].children)
+
+    def _walk(self, name, attr):
+        """Get IDs of all jobs reachable from `name` by following `attr` (parents/children)."""
+        start = self._ids[name]
+        seen = set([start])
+        found = []
+        queue = deque([start])
+        while queue:
+            for other in getattr(self._nodes[queue.popleft()], attr):
+                if other not in seen:
+                    seen.add(other)
+                    found.append(other)
+                    queue.append(other)
+        return found
+
+    def ancestors(self, name):
+        """Get names of all jobs that must run before `name`, nearest first."""
+        return self._names(self._walk(name, 'parents'))
+
+    def descendants(self, name):
+        """Get names of all jobs that cannot run until `name` has, nearest first."""
+        return self._names(self._walk(name, 'children'))
+
+    def roots(self):
+        """Get names of added jobs that have no requirements."""
+        return self._names(sorted(self._roots))
+
+    def leaves(self):
+        """Get names of added jobs that no other job requires."""
+        return self._names(sorted(self._leaves))
+
+    def topological_order(self):
+        """Get names of added jobs, ordered such that every job comes after
+        all the jobs it requires.
+
+        Requirements that have not been added are ignored.
+
+        Returns
+        -------
+        list[str]
+
+        Raises
+        ------
+        RuntimeError
+            If the graph has a cycle.
+        """
+        nodes = self._nodes
+        n_parents = {}
+        for node_id in self._order:
+            n_parents[node_id] = sum(1 for p in nodes[node_id].parents if nodes[p].job is not None)
+        queue = deque(i for i in self._order if n_parents[i] == 0)
+        order = []
+        while queue:
+            node_id = queue.popleft()
+            order.append(node_id)
+            for child in nodes[node_id].children:
+                if child in n_parents:
+                    n_parents[child] -= 1
+                    if n_parents[child] == 0:
+                        queue.append(child)
+        if len(order) != len(self._order):
+            raise RuntimeError('Cannot have cyclic dependencies: %s'
+                               % ' ->- '.join(self.find_cycle()))
+        return self._names(order)
+
+    def find_cycle(self):
+        """Find the first cycle of requirements in the graph, if there is one.
+
+        Requirements that have not been added are ignored.
+        Takes time proportional to the number of jobs + requirements.
+
+        Returns
+        -------
+        list[str]
+            Names of jobs in the cycle, from parent to child, starting and
+            ending with the same job. Empty if there are no cycles.
+        """
+        nodes = self._nodes
+        # State of each job: absent = unvisited, True = on current path,
+        # False = finished (it and all its ancestors have no cycles)
+        on_path = {}
+        for start in self._order:
+            if start in on_path:
+                continue
+            # Iterative DFS up through parents. Each entry in stack is an
+            # iterator over the remaining parents of the job at the same
+            # position in path.
+            on_path[start] = True
+            path = [start]
+            stack = [iter(nodes[start].parents)]
+            while stack:
+                for parent in stack[-1]:
+                    if nodes[parent].job is None:
+                        continue
+                    state = on_path.get(parent)
+                    if state is None:
+                        on_path[parent] = True
+                        path.append(parent)
+                        stack.append(iter(nodes[parent].parents))
+                        break
+                    elif state:
+                        # path runs child -> parent, so reverse it
+                        cycle = path[path.index(parent):] + [parent]
+                        return self._names(cycle[::-1])
+                else:
+                    on_path[path.pop()] = False
+                    stack.pop()
+        return []
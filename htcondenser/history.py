@@ -0,0 +1,163 @@
+"""
+Class to keep a local record of the resources used by previous jobs, to
+choose the resources to request for new jobs.
+"""
+
+
+import logging
+import math
+import os
+from collections import OrderedDict
+import json
+from htcondenser.common import check_dir_create, date_time_now
+from htcondenser.condorlog import collect_job_stats, percentile
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_HISTORY_FILE = os.path.join(os.path.expanduser('~'), '.htcondenser', 'history.json')
+
+
+class ResourceHistory(object):
+    """Persistent record of the memory & disk used by previous jobs, grouped
+    by a key (usually the executable).
+
+    Only the most recent `max_samples` jobs are kept for each key, so that
+    the file stays small. The IDs of the jobs recorded from logs are also
+    kept, so recording the same logs again does not count them twice.
+
+    Parameters
+    ----------
+    filename : str, optional
+        JSON file to hold the history. Loaded if it already exists.
+
+    max_samples : int, optional
+        Maximum number of jobs to keep for each key.
+
+    max_job_ids : int, optional
+        Maximum number of recorded job IDs to keep for each key.
+    """
+
+    def __init__(self, filename=DEFAULT_HISTORY_FILE, max_samples=5000, max_job_ids=100000):
+        super(ResourceHistory, self).__init__()
+        self.filename = filename
+        self.max_samples = int(max_samples)
+        self.max_job_ids = int(max_job_ids)
+        # key is e.g. exe, value is dict of memory_mb & disk_kb lists, IDs of
+        # recorded jobs, and when updated
+        self.entries = {}
+        if os.path.isfile(self.filename):
+            with open(self.filename) as hfile:
+                self.entries = json.load(hfile)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def record(self, key, memory_mb, disk_kb, job_ids=None):
+        """Add the memory & disk used by some jobs.
+
+        Parameters
+        ----------
+        key : str
+            Key for the jobs, e.g. exe.
+
+        memory_mb : list[float]
+            Peak memory used by each job, in MB.
+
+        disk_kb : list[float]
+            Disk used by each job, in KB.
+
+        job_ids : list[str], optional
+            cluster.process IDs of the jobs, so they are not recorded again
+            by record_logs().
+        """
+        entry = self.entries.setdefault(key, dict(memory_mb=[], disk_kb=[]))
+        for name, values in [('memory_mb', memory_mb), ('disk_kb', disk_kb)]:
+            entry[name].extend(values)
+            del entry[name][:-self.max_samples]
+        if job_ids:
+            entry.setdefault('job_ids', []).extend(job_ids)
+            del entry['job_ids'][:-self.max_job_ids]
+        entry['updated'] = date_time_now()
+
+    def record_logs(self, key, log_dir, processes=None):
+        """Add the memory & disk used by the jobs with HTCondor job logs
+        under `log_dir`. Jobs that have already been recorded, or have not
+        finished yet, are skipped.
+
+        Parameters
+        ----------
+        key : str
+            Key for the jobs, e.g. exe.
+
+        log_dir : str
+            Directory to search for HTCondor job logs.
+
+        processes : int, optional
+            Number of processes to parse logs with.
+
+        Returns
+        -------
+        int
+            Number of new jobs recorded.
+        """
+        recorded = set(self.entries.get(key, {}).get('job_ids', []))
+        new_job_ids = []
+
+        def is_new(summary):
+            # Usage of a running job is not final, so record it once it ends
+            if summary.end_time is None or summary.job_id in recorded:
+                return False
+            recorded.add(summary.job_id)
+            new_job_ids.append(summary.job_id)
+            return True
+
+        stats = collect_job_stats(log_dir, processes=processes, group_by=lambda f: key,
+                                  job_filter=is_new)
+        if key not in stats.values:
+            log.warning('No new jobs found in %s', log_dir)
+            return 0
+        values = stats.values[key]
+        self.record(key, list(values['memory']), list(values['disk']), new_job_ids)
+        return stats.counts[key]['jobs']
+
+    def suggest(self, key, fraction=0.95, headroom=1.2):
+        """Suggest how much memory & disk to request for a job.
+
+        Parameters
+        ----------
+        key : str
+            Key for the jobs, e.g. exe.
+
+        fraction : float, optional
+            Percentile of previous jobs' usage, as a fraction.
+
+        headroom : float, optional
+            Factor to multiply the percentile by.
+
+        Returns
+        -------
+        OrderedDict
+            'memory' & 'disk' requests in MB, as strings e.g. '512MB'.
+            Either is missing if there is no history for it.
+        """
+        suggestion = OrderedDict()
+        entry = self.entries.get(key)
+        if not entry:
+            return suggestion
+        for name, values, per_mb in [('memory', entry['memory_mb'], 1),
+                                     ('disk', entry['disk_kb'], 1024)]:
+            if values:
+                value = percentile(sorted(values), fraction) * headroom / per_mb
+                suggestion[name] = '%dMB' % max(int(math.ceil(value)), 1)
+        return suggestion
+
+    def save(self):
+        """Write the history to file."""
+        log.debug('Writing resource history to %s', self.filename)
+        check_dir_create(os.path.dirname(os.path.realpath(self.filename)))
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as hfile:
+            json.dump(self.entries, hfile, indent=0, sort_keys=True)
+        os.rename(tmp_filename, self.filename)
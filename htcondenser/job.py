@@ -6,8 +6,8 @@ Classes to describe individual job, as part of a JobSet.
 import logging
 import os
 import htcondenser as ht
-from htcondenser.common import cp_hdfs, check_dir_create
-from itertools import chain
+from htcondenser.common import generate_input_arg_parts, join_worker_args
+from htcondenser.staging import FileStager
 
 
 log = logging.getLogger(__name__)
@@ -62,6 +62,11 @@ class Job(object):
                  quantity=1, hdfs_mirror_dir=None):
         super(Job, self).__init__()
         self._manager = None
+        # Cached result of generate_job_arg_str(), and the manager's
+        # arg_version it was made with. Cleared when the args, file mirrors,
+        # or manager are set.
+        self._arg_str = None
+        self._arg_str_version = None
         self.name = str(name)
         if not args:
             args = []
@@ -83,6 +88,59 @@ class Job(object):
     def __eq__(self, other):
         return self.name == other.name
 
+    def __hash__(self):
+        # Python 3 needs this explicitly since __eq__ is defined
+        return hash(self.name)
+
+    @property
+    def args(self):
+        """List of arguments for the exe."""
+        return self._args
+
+    @args.setter
+    def args(self, args):
+        self._args = args
+        self.clear_arg_str_cache()
+
+    @property
+    def input_file_mirrors(self):
+        """List of FileMirrors for the input files."""
+        return self._input_file_mirrors
+
+    @input_file_mirrors.setter
+    def input_file_mirrors(self, mirrors):
+        self._input_file_mirrors = mirrors
+        self.clear_arg_str_cache()
+
+    @property
+    def output_file_mirrors(self):
+        """List of FileMirrors for the output files."""
+        return self._output_file_mirrors
+
+    @output_file_mirrors.setter
+    def output_file_mirrors(self, mirrors):
+        self._output_file_mirrors = mirrors
+        self.clear_arg_str_cache()
+
+    @property
+    def hdfs_mirror_dir(self):
+        """Directory on HDFS for this Job's files."""
+        return self._hdfs_mirror_dir
+
+    @hdfs_mirror_dir.setter
+    def hdfs_mirror_dir(self, hdfs_mirror_dir):
+        self._hdfs_mirror_dir = hdfs_mirror_dir
+        self.clear_arg_str_cache()
+
+    def clear_arg_str_cache(self):
+        """Make generate_job_arg_str() regenerate the argument string.
+
+        This is done automatically when args, the file mirrors,
+        hdfs_mirror_dir or manager are set, but must be called after changing
+        any of them in place, e.g. with job.args.append().
+        """
+        self._arg_str = None
+
     @property
     def manager(self):
         """Returns the Job's managing JobSet."""
@@ -98,6 +156,7 @@ class Job(object):
         if not isinstance(manager, ht.JobSet):
             raise TypeError('Incorrect object type set as Job manager - requires a JobSet object')
         self._manager = manager
+        self.clear_arg_str_cache()
         if manager.copy_exe:
             self.input_files.append(manager.exe)
         if manager.setup_script:
@@ -125,14 +184,17 @@ class Job(object):
         """
         for ifile in self.input_files:
             basename = os.path.basename(ifile)
-            mirror_dir = hdfs_mirror_dir
-            if (ifile in [self.manager.exe, self.manager.setup_script] and
-                    self.manager.share_exe_setup):
-                mirror_dir = self.manager.hdfs_store
-            hdfs_mirror = (ifile if ifile.startswith('/hdfs')
-                           else os.path.join(mirror_dir, basename))
+            if ifile in [self.manager.exe, self.manager.setup_script]:
+                mirror_dir = hdfs_mirror_dir
+                if self.manager.share_exe_setup:
+                    mirror_dir = self.manager.hdfs_store
+                hdfs_mirror = (ifile if ifile.startswith('/hdfs')
+                               else os.path.join(mirror_dir, basename))
+            else:
+                hdfs_mirror = self.manager.generate_hdfs_mirror_path(ifile, hdfs_mirror_dir)
             mirror = ht.FileMirror(original=ifile, hdfs=hdfs_mirror, worker=basename)
             self.input_file_mirrors.append(mirror)
+        self.clear_arg_str_cache()
 
     def setup_output_file_mirrors(self, hdfs_mirror_dir):
         """Attach a mirror HDFS location for each output file.
@@ -156,30 +218,64 @@ class Job(object):
                 worker = ofile
             mirror = ht.FileMirror(original=ofile, hdfs=hdfs_mirror, worker=worker)
             self.output_file_mirrors.append(mirror)
+        self.clear_arg_str_cache()
 
-    def transfer_to_hdfs(self):
-        """Transfer files across to HDFS.
+    def get_files_to_transfer(self):
+        """Get the FileMirrors for input files that this Job needs copying to HDFS.
 
-        Auto-creates HDFS mirror dir if it doesn't exist, but only if
-        there are 1 or more files to transfer.
+        Will not include exe or setup script if manager.share_exe_setup is True.
+        That is left for the manager to do. Also skips files already stored in
+        the manager's content store.
 
-        Will not transfer exe or setup script if manager.share_exe_setup is True.
-        That is left for the manager to do.
+        Returns
+        -------
+        list[FileMirror]
+            Mirrors whose original needs copying to the HDFS location.
         """
         # skip the exe.setup script - the JobSet should handle this itself.
         files_to_transfer = []
+        content_store = self.manager.content_store
         for ifile in self.input_file_mirrors:
             if ((ifile.original == ifile.hdfs) or (self.manager.share_exe_setup and
                     ifile.original in [self.manager.exe, self.manager.setup_script])):
                 continue
+            if content_store and content_store.contains(ifile):
+                log.debug('%s already stored as %s', ifile.original, ifile.hdfs)
+                continue
             files_to_transfer.append(ifile)
+        return files_to_transfer
+
+    def transfer_to_hdfs(self, num_workers=4, batch_size=50):
+        """Transfer files across to HDFS.
+
+        Auto-creates HDFS mirror dir if it doesn't exist, but only if
+        there are 1 or more files to transfer.
 
-        if len(files_to_transfer) > 0:
-            check_dir_create(self.hdfs_mirror_dir)
+        Will not transfer exe or setup script if manager.share_exe_setup is True.
+        That is left for the manager to do.
+
+        Parameters
+        ----------
+        num_workers : int, optional
+            Maximum number of copy commands to run concurrently.
 
-        for ifile in files_to_transfer:
-            log.info('Copying %s -->> %s', ifile.original, ifile.hdfs)
-            cp_hdfs(ifile.original, ifile.hdfs)
+        batch_size : int, optional
+            Maximum number of files to copy with a single command.
+        """
+        stager = FileStager(num_workers=num_workers, batch_size=batch_size)
+        stager.add_mirrors(self.get_files_to_transfer())
+        stager.transfer()
+
+    def generate_report_filename(self):
+        """Get the filename for the worker's JSON report, if manager.worker_report is set.
+
+        The worker replaces {cluster} and {process} with the job's IDs.
+
+        Returns
+        -------
+        str
+        """
+        return os.path.join(self.hdfs_mirror_dir, '{cluster}.{process}.report.json')
 
     def generate_job_arg_str(self):
         """Generate arg string to pass to the condor_worker.py script.
@@ -187,7 +283,12 @@ class Job(object):
         This includes the user's args (in `self.args`), but also includes options
         for input and output files, and automatically updating the args to
         account for new locations on HDFS or worker node. It also includes
-        common input files from managing JobSet.
+        common input files from managing JobSet, which are only processed once
+        per JobSet.
+
+        The result is cached until this Job's args, file mirrors,
+        hdfs_mirror_dir or manager are set, or the manager's arg_version
+        changes. See clear_arg_str_cache() for changes made in place.
 
         Returns
         -------
@@ -195,50 +296,55 @@ class Job(object):
             Argument string for the job, to be passed to condor_worker.py
 
         """
+        if self._arg_str is not None and self._arg_str_version == self.manager.arg_version:
+            return self._arg_str
+
+        common_str, common_replacements = self.manager.generate_common_arg_parts()
+
         job_args = []
         if self.manager.setup_script:
             job_args.extend(['--setup', os.path.basename(self.manager.setup_script)])
 
-        new_args = self.args[:]
-        if self.manager.transfer_hdfs_input:
-            # Replace input files in exe args with their worker node copies
-            for ifile in chain(self.input_file_mirrors, self.manager.common_input_file_mirrors):
-                for i, arg in enumerate(new_args):
-                    if arg == ifile.original:
-                        new_args[i] = ifile.worker
-
-                # Add input files to be transferred across
-                job_args.extend(['--copyToLocal', ifile.hdfs, ifile.worker])
-        else:
-            # Replace input files in exe args with their HDFS node copies
-            for ifile in chain(self.input_file_mirrors, self.manager.common_input_file_mirrors):
-                for i, arg in enumerate(new_args):
-                    if arg == ifile.original:
-                        new_args[i] = ifile.hdfs
-                # Add input files to be transferred across,
-                # but only if they originally aren't on hdfs
-                if not ifile.original.startswith('/hdfs'):
-                    job_args.extend(['--copyToLocal', ifile.hdfs, ifile.worker])
+        if self.manager.prefetch_inputs is not None:
+            job_args.extend(['--prefetch', self.manager.prefetch_inputs])
+
+        # Add input files to be transferred across, and replace input files in
+        # exe args with their worker node/HDFS copies
+        copy_args, replacements = generate_input_arg_parts(self.input_file_mirrors,
+                                                           self.manager.transfer_hdfs_input)
+        job_args.extend(copy_args)
+        new_args = [replacements.get(arg, common_replacements.get(arg, arg))
+                    for arg in self.args]
 
         log.debug("New job args:")
         log.debug(new_args)
 
-        # Add output files to be transferred across
+        # Add output files to be transferred across, or streamed if possible
         # Replace output files in exe args with their worker node copies
+        end_args = []
+        out_replacements = {}
         for ofile in self.output_file_mirrors:
-            for i, arg in enumerate(new_args):
-                if arg == ofile.original or arg == ofile.hdfs:
-                    new_args[i] = ofile.worker
-            job_args.extend(['--copyFromLocal', ofile.worker, ofile.hdfs])
+            out_replacements.setdefault(ofile.original, ofile.worker)
+            out_replacements.setdefault(ofile.hdfs, ofile.worker)
+            option = '--copyFromLocal'
+            if self.manager.stream_output and ofile.hdfs.startswith('/hdfs'):
+                option = '--streamFromLocal'
+            end_args.extend([option, ofile.worker, ofile.hdfs])
+        new_args = [out_replacements.get(arg, arg) for arg in new_args]
+
+        if self.manager.worker_report:
+            end_args.extend(['--report', self.generate_report_filename()])
 
         # Add the exe
-        job_args.extend(['--exe', os.path.basename(self.manager.exe)])
+        end_args.extend(['--exe', os.path.basename(self.manager.exe)])
 
         # Add arguments for exe MUST COME LAST AS GREEDY
         if new_args:
-            job_args.append('--args')
-            job_args.extend(new_args)
+            end_args.append('--args')
+            end_args.extend(new_args)
 
         # Convert everything to str, and convert double quotes properly
-        job_args = [str(x).replace('"', '""') for x in job_args]
-        return ' '.join(job_args)
+        arg_str = ' '.join([part for part in (join_worker_args(job_args), common_str,
+                                              join_worker_args(end_args)) if part])
+        self._arg_str, self._arg_str_version = arg_str, self.manager.arg_version
+        return arg_str
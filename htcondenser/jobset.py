@@ -4,10 +4,14 @@ Class to describe groups of jobs sharing common settings, that becomes one condo
 
 
 import logging
+import numbers
 import os
 import re
 from subprocess import check_call
-from htcondenser.common import cp_hdfs, check_certificate, check_dir_create
+from htcondenser.common import (check_certificate, check_dir_create, check_dirs_create,
+                                generate_input_arg_parts, join_worker_args, write_file_parts,
+                                IndexedDict, string_types)
+from htcondenser.staging import FileStager, TransferManifest, ContentStore
 from collections import OrderedDict
 import htcondenser as ht
 
@@ -63,6 +67,7 @@ class JobSet(object):
 
     disk : str, optional
         Disk space to request for each job.
+        See right_size() to choose `memory` & `disk` from previous jobs.
 
     certificate : bool, optional
         Whether the JobSet requires the user's grid certificate.
@@ -91,6 +96,56 @@ class JobSet(object):
         input files, in a subdirectory with the Job name. If this directory does
         not exist, it will be created.
 
+    dedup_input_files : bool, optional
+        If True, input files not on HDFS are stored once in `hdfs_store`/blobs,
+        named by the hash of their contents, instead of a copy per Job.
+        Jobs using identical files then share one copy on HDFS, and files
+        already stored by previous submissions are not copied again.
+        Does not apply to the exe or setup script.
+
+    queue_from_file : bool, optional
+        If True, then when not part of a DAG, all jobs are queued with a single
+        ``queue ... from`` statement, reading each job's arguments from an
+        item file next to the submit file (see generate_item_filename()).
+        This makes for much smaller submit files with many jobs.
+        Otherwise, each job has its own ``arguments`` and ``queue`` statements.
+
+    prefetch_inputs : int, optional
+        If set, each job's executable is started once this many of its input
+        files (plus the executable & setup script) are on the worker node,
+        and the rest are copied in the background while it runs, in the order
+        they are listed. This suits executables that read their inputs in order.
+        The executable must wait for the marker file ``<input file>.ready``
+        before opening each input file. ``stagein.done`` is made once all
+        files are copied, or ``stagein.failed`` if copying fails.
+
+    node_cache_dir : str, optional
+        If set, common input files are kept in this directory on each worker
+        node, and shared between all jobs that run there, instead of being
+        copied for every job. Must be a path that jobs can write to on the
+        worker node, e.g. /tmp/htcondenser_cache.
+
+    node_cache_max_size : str, optional
+        Maximum total size of files in `node_cache_dir`, e.g. '10GB'. Least
+        recently used files are removed to keep under this.
+
+    stream_output : bool, optional
+        If True, output files destined for HDFS are streamed there while the
+        executable writes them, via a named pipe, instead of being written to
+        the worker node's disk and copied afterwards. This overlaps copying
+        with running, and needs less disk space on the worker node. Only
+        suitable for output files that are written sequentially (e.g. not
+        ROOT files, which are written out of order). If streaming fails,
+        the file is saved locally and copied afterwards, as long as it is
+        not too large.
+
+    worker_report : bool, optional
+        If True, each job saves a JSON report of its timings (setup, copying
+        input files, execution, copying output files), the size and copy time
+        of each file, the peak memory & CPU time of the executable, and its
+        exit code. It is saved as `<hdfs_mirror_dir>/<cluster>.<process>.report.json`
+        alongside the job's output files.
+
     other_args: dict, optional
         Dictionary of other job options to write to HTCondor submit file.
         These will be added in **before** any arguments or jobs.
@@ -105,6 +160,13 @@ class JobSet(object):
 
     """
 
+    # Attributes used in the condor_worker.py arguments of the Jobs.
+    # Setting any of them increments arg_version, so that the Jobs know to
+    # regenerate their argument strings.
+    ARG_ATTRS = frozenset(['exe', 'setup_script', 'transfer_hdfs_input', 'prefetch_inputs',
+                           'stream_output', 'worker_report', 'common_input_file_mirrors',
+                           'node_cache_dir', 'node_cache_max_size'])
+
     def __init__(self,
                  exe,
                  copy_exe=True,
@@ -120,8 +182,16 @@ class JobSet(object):
                  common_input_files=None,
                  hdfs_store=None,
                  dag_mode=False,
+                 dedup_input_files=False,
+                 queue_from_file=False,
+                 prefetch_inputs=None,
+                 node_cache_dir=None,
+                 node_cache_max_size='10GB',
+                 stream_output=False,
+                 worker_report=False,
                  other_args=None):
         super(JobSet, self).__init__()
+        self.arg_version = 0
         self.exe = exe
         self.copy_exe = copy_exe
         self.setup_script = setup_script
@@ -143,22 +213,33 @@ class JobSet(object):
             common_input_files = []
         self.common_input_files = common_input_files[:]
         self.common_input_file_mirrors = []  # To hold FileMirror obj
+        # Cache for generate_common_arg_parts(), as (arg_version, arg str, replacements)
+        self._common_arg_parts = None
         if hdfs_store is None:
             raise IOError('Need to specify hdfs_store')
         self.hdfs_store = hdfs_store
+        self.content_store = None
+        if dedup_input_files:
+            self.content_store = ContentStore(os.path.join(self.hdfs_store, 'blobs'))
         # self.dag_mode = dag_mode
         self.job_template = os.path.join(os.path.dirname(__file__), 'templates/job.condor')
+        self.queue_from_file = queue_from_file
+        self.prefetch_inputs = None if prefetch_inputs is None else max(int(prefetch_inputs), 0)
+        self.node_cache_dir = node_cache_dir
+        self.node_cache_max_size = str(node_cache_max_size)
+        self.stream_output = stream_output
+        self.worker_report = worker_report
         self.other_job_args = other_args
         # Hold all Job object this JobSet manages, key is Job name.
-        self.jobs = OrderedDict()
+        # Indexed, so that JobSet[i] does not need a list of all Jobs.
+        self.jobs = IndexedDict()
 
 
         # Setup directories
         # ---------------------------------------------------------------------
-        for d in [self.out_dir, self.err_dir, self.log_dir, self.hdfs_store]:
-            if d:
-                log.info('Making directory %s', d)
-                check_dir_create(d)
+        dirs = [d for d in [self.out_dir, self.err_dir, self.log_dir, self.hdfs_store] if d]
+        log.info('Making directories %s', ', '.join(OrderedDict.fromkeys(dirs)))
+        check_dirs_create(dirs)
 
         # Check output filenames are not blank
         # ---------------------------------------------------------------------
@@ -171,22 +252,39 @@ class JobSet(object):
         # ---------------------------------------------------------------------
         self.setup_common_input_file_mirrors(self.hdfs_store)
 
+    def __setattr__(self, name, value):
+        super(JobSet, self).__setattr__(name, value)
+        if name in self.ARG_ATTRS:
+            self.clear_arg_str_cache()
+
     def __eq__(self, other):
         return self.filename == other.filename
 
+    def __hash__(self):
+        # Python 3 needs this explicitly since __eq__ is defined
+        return hash(self.filename)
+
     def __getitem__(self, i):
-        if isinstance(i, int):
-            if i >= len(self):
-                raise IndexError()
-            return self.jobs.values()[i]
-        elif isinstance(i, slice):
-            return self.jobs.values()[i]
+        """Get Job(s) by position or slice, in the order they were added,
+        or by name."""
+        if isinstance(i, (numbers.Integral, slice)):
+            return self.jobs.value_at(i)
+        elif isinstance(i, string_types):
+            return self.jobs[i]
         else:
-            raise TypeError('Invalid argument type - must be int or slice')
+            raise TypeError('Invalid argument type - must be int, slice or str')
 
     def __len__(self):
         return len(self.jobs)
 
+    def __iter__(self):
+        """Iterate over Jobs, in the order they were added."""
+        return iter(self.jobs.values())
+
+    def __contains__(self, job):
+        """Check if a Job, or a job name, is in this JobSet."""
+        return getattr(job, 'name', job) in self.jobs
+
     def setup_common_input_file_mirrors(self, hdfs_mirror_dir):
         """Attach a mirror HDFS location for each non-HDFS input file.
         Also attaches a location for the worker node, incase the user wishes to
@@ -200,11 +298,68 @@ class JobSet(object):
         for ifile in self.common_input_files:
             ifile = os.path.abspath(ifile)
             basename = os.path.basename(ifile)
-            mirror_dir = hdfs_mirror_dir
-            hdfs_mirror = (ifile if ifile.startswith('/hdfs')
-                           else os.path.join(mirror_dir, basename))
+            hdfs_mirror = self.generate_hdfs_mirror_path(ifile, hdfs_mirror_dir)
             mirror = ht.FileMirror(original=ifile, hdfs=hdfs_mirror, worker=basename)
             self.common_input_file_mirrors.append(mirror)
+        self.clear_arg_str_cache()
+
+    def clear_arg_str_cache(self):
+        """Make every Job regenerate its condor_worker.py argument string.
+
+        This is done automatically when any of ARG_ATTRS is set, but must be
+        called after changing any of them in place, e.g. with
+        common_input_file_mirrors.append().
+        """
+        self.arg_version = getattr(self, 'arg_version', 0) + 1
+
+    def generate_common_arg_parts(self):
+        """Generate the portion of every Job's condor_worker.py argument string
+        that deals with the common input files.
+
+        The result is cached until arg_version changes.
+
+        Returns
+        -------
+        str, dict
+            Options to fetch the common input files, and dict of {original
+            filepath: replacement} for the exe arguments.
+        """
+        if self._common_arg_parts is None or self._common_arg_parts[0] != self.arg_version:
+            option = '--copyToLocalCached' if self.node_cache_dir else '--copyToLocal'
+            copy_args, replacements = generate_input_arg_parts(self.common_input_file_mirrors,
+                                                               self.transfer_hdfs_input,
+                                                               option)
+            if self.node_cache_dir and copy_args:
+                copy_args = ['--cacheDir', self.node_cache_dir,
+                             '--cacheMaxSize', self.node_cache_max_size] + copy_args
+            self._common_arg_parts = (self.arg_version, join_worker_args(copy_args), replacements)
+        return self._common_arg_parts[1], self._common_arg_parts[2]
+
+    def generate_hdfs_mirror_path(self, filename, hdfs_mirror_dir):
+        """Get the location on HDFS for a mirrored copy of an input file.
+
+        Files already on HDFS are not mirrored. If self.content_store is set,
+        the location is the file's blob in the store, otherwise the file is
+        put in `hdfs_mirror_dir`.
+
+        Parameters
+        ----------
+        filename : str
+            Filepath of input file.
+
+        hdfs_mirror_dir : str
+            Location of directory to store mirrored copies.
+
+        Returns
+        -------
+        str
+            Filepath of mirror on HDFS.
+        """
+        if filename.startswith('/hdfs'):
+            return filename
+        if self.content_store and os.path.isfile(filename):
+            return self.content_store.generate_blob_path(filename)
+        return os.path.join(hdfs_mirror_dir, os.path.basename(filename))
 
     def add_job(self, job):
         """Add a Job to the collection of jobs managed by this JobSet.
@@ -231,18 +386,139 @@ class JobSet(object):
         self.jobs[job.name] = job
         job.manager = self
 
+    def add_jobs(self, jobs):
+        """Add many Jobs to the collection of jobs managed by this JobSet.
+
+        All jobs are checked before any are added, so if any job is invalid,
+        the JobSet is left unchanged.
+
+        Parameters
+        ----------
+        jobs : iterable[Job]
+            Job objects to be added.
+
+        Raises
+        ------
+        TypeError
+            If any item in `jobs` isn't of type Job (or derived type).
+
+        KeyError
+            If a job with the same name is already governed by this JobSet
+            object, or appears twice in `jobs`.
+        """
+        jobs = list(jobs)
+        names = set()
+        for job in jobs:
+            if not isinstance(job, ht.Job):
+                raise TypeError('Added job must by of type Job')
+            if job.name in names or job.name in self.jobs:
+                raise KeyError('Job %s already exists in JobSet' % job.name)
+            names.add(job.name)
+
+        for job in jobs:
+            self.jobs[job.name] = job
+            job.manager = self
+
+    def right_size(self, log_dir=None, history=None, key=None,
+                   percentile=0.95, headroom=1.2, apply=True):
+        """Choose the memory & disk to request, from the usage of previous
+        jobs with the same exe.
+
+        Parameters
+        ----------
+        log_dir : str, optional
+            Directory with the HTCondor job logs of a previous campaign.
+            If set, the usage of jobs not already in the history is added to
+            it and saved first.
+
+        history : ResourceHistory or str, optional
+            History, or its filename. Defaults to ~/.htcondenser/history.json
+
+        key : str, optional
+            Key for these jobs in the history. Defaults to the real path of the exe.
+
+        percentile : float, optional
+            Percentile of previous jobs' usage to request, as a fraction.
+
+        headroom : float, optional
+            Factor to multiply the percentile by.
+
+        apply : bool, optional
+            If True, set self.memory & self.disk to the suggestions, so they
+            are used in the submit file. Otherwise only return them.
+
+        Returns
+        -------
+        OrderedDict
+            Suggested 'memory' & 'disk', e.g. '512MB'. Empty if there is no
+            history for these jobs.
+        """
+        # imported here, since reading job logs needs slow-to-import modules
+        from htcondenser.history import ResourceHistory
+        if history is None:
+            history = ResourceHistory()
+        elif not isinstance(history, ResourceHistory):
+            history = ResourceHistory(history)
+        key = key or os.path.realpath(self.exe)
+
+        if log_dir:
+            n_jobs = history.record_logs(key, log_dir)
+            log.info('Recorded resource usage of %d new jobs from %s', n_jobs, log_dir)
+            history.save()
+
+        suggestion = history.suggest(key, fraction=percentile, headroom=headroom)
+        if not suggestion:
+            log.warning('No resource history for %s, keeping memory=%s, disk=%s',
+                        key, self.memory, self.disk)
+        elif apply:
+            for attr, value in suggestion.items():
+                log.info('Setting %s from %s to %s', attr, getattr(self, attr), value)
+                setattr(self, attr, value)
+        return suggestion
+
     def write(self, dag_mode):
-        """Write jobs to HTCondor job file."""
+        """Write jobs to HTCondor job file.
+
+        If self.queue_from_file is True and not in `dag_mode`, also writes
+        the item file with each job's arguments.
+        """
 
         with open(self.job_template) as tfile:
             template = tfile.read()
 
-        file_contents = self.generate_file_contents(template, dag_mode)
-
         log.info('Writing HTCondor job file to %s', self.filename)
         check_dir_create(os.path.dirname(os.path.realpath(self.filename)))
-        with open(self.filename, 'w') as jfile:
-            jfile.write(file_contents)
+        write_file_parts(self.filename, self.generate_file_parts(template, dag_mode))
+
+        if self.queue_from_file and not dag_mode:
+            log.info('Writing HTCondor item file to %s', self.generate_item_filename())
+            write_file_parts(self.generate_item_filename(), self.generate_item_lines())
+
+    def generate_item_filename(self):
+        """Get the filename of the item file used if self.queue_from_file is True.
+
+        Returns
+        -------
+        str
+            Filename, next to the HTCondor job file.
+        """
+        return os.path.realpath(os.path.splitext(self.filename)[0] + '.items')
+
+    def generate_item_lines(self):
+        """Generate the lines of the item file, one per job to be queued.
+
+        Each line holds the argument string for that job. Jobs with
+        quantity > 1 have their line repeated.
+
+        Yields
+        ------
+        str
+            Line for item file, including newline.
+        """
+        for job in self.jobs.values():
+            line = job.generate_job_arg_str() + '\n'
+            for _ in range(job.quantity):
+                yield line
 
     def generate_file_contents(self, template, dag_mode=False):
         """Create a job file contents from a template, replacing necessary fields
@@ -259,13 +535,40 @@ class JobSet(object):
         dag_mode : bool, optional
             If True, then submit file will only contain placeholder for job args.
             This is so it can be used in a DAG. Otherwise, the submit file will
-            specify each Job attached to this JobSet.
+            specify each Job attached to this JobSet, or if self.queue_from_file
+            is True, read them from the item file.
 
         Returns
         -------
         str
             Completed job template.
 
+        Raises
+        ------
+        IndexError
+            If the JobSet has no Jobs attached.
+        """
+        return ''.join(self.generate_file_parts(template, dag_mode))
+
+    def generate_file_parts(self, template, dag_mode=False):
+        """Generate the job file contents piece by piece, so that they can be
+        written out without holding the whole file in memory.
+
+        See generate_file_contents() for details.
+
+        Parameters
+        ----------
+        template : str
+            Job template as a single string, including tokens to be replaced.
+
+        dag_mode : bool, optional
+            If True, then submit file will only contain placeholder for job args.
+
+        Yields
+        ------
+        str
+            Part of the job file: first the filled template, then each job.
+
         Raises
         ------
         IndexError
@@ -293,8 +596,9 @@ class JobSet(object):
             self.other_job_args['use_x509userproxy'] = 'True'
 
         if self.other_job_args:
+            # sorted, so the file is the same whatever the dict ordering
             other_args_str = '\n'.join('%s = %s' % (str(k), str(v))
-                                       for k, v in self.other_job_args.iteritems())
+                                       for k, v in sorted(self.other_job_args.items()))
         else:
             other_args_str = None
 
@@ -310,22 +614,10 @@ class JobSet(object):
             'OTHER_ARGS': other_args_str
         }
 
-        for pattern, replacement in replacement_dict.iteritems():
+        for pattern, replacement in replacement_dict.items():
             if replacement:
                 template = template.replace("{%s}" % pattern, replacement)
 
-        # Add jobs
-        if dag_mode:
-            # actual arguments are in the DAG file, only placeholders here
-            template += 'arguments=$(%s)\n' % ht.DAGMan.JOB_VAR_NAME
-            template += 'queue\n'
-        else:
-            # specifiy each job in submit file
-            for name, job in self.jobs.iteritems():
-                template += '\n# %s\n' % name
-                template += 'arguments="%s"\n' % job.generate_job_arg_str()
-                template += '\nqueue %d\n' % job.quantity
-
         # Check we haven't left any unused tokens in the template.
         # If we have, then remove them.
         leftover_tokens = re.findall(r'{\w*}', template)
@@ -333,36 +625,103 @@ class JobSet(object):
             log.debug('Leftover tokens in job file:')
         for tok in leftover_tokens:
             log.debug('%s', tok)
-            template = template.replace(tok, '')
+        yield re.sub(r'{\w*}', '', template)
 
-        return template
+        # Add jobs
+        if dag_mode:
+            # actual arguments are in the DAG file, only placeholders here
+            yield 'arguments=$(%s)\n' % ht.DAGMan.JOB_VAR_NAME
+            yield 'queue\n'
+        elif self.queue_from_file:
+            # arguments for each job are in the item file
+            yield 'arguments="$(%s)"\n' % ht.DAGMan.JOB_VAR_NAME
+            yield 'queue %s from %s\n' % (ht.DAGMan.JOB_VAR_NAME, self.generate_item_filename())
+        else:
+            # specifiy each job in submit file
+            for name, job in self.jobs.items():
+                arg_str = job.generate_job_arg_str()
+                yield '\n# %s\narguments="%s"\n\nqueue %d\n' % (name, arg_str, job.quantity)
 
-    def transfer_to_hdfs(self):
-        """Copy any necessary input files to HDFS.
+    def get_files_to_transfer(self):
+        """Get the FileMirrors for all files that need copying to HDFS.
 
-        This transfers both common exe/setup (if self.share_exe_setup == True),
-        and the individual files required by each Job.
+        This includes the common exe/setup (if self.share_exe_setup == True),
+        the common input files, and the individual files required by each Job.
+
+        Returns
+        -------
+        list[FileMirror]
+            Mirrors whose original needs copying to the HDFS location.
         """
+        mirrors = []
         # Do copying of exe/setup script here instead of through Jobs if only
         # 1 instance required on HDFS.
         if self.share_exe_setup:
             if self.copy_exe:
-                log.info('Copying %s -->> %s', self.exe, self.hdfs_store)
-                cp_hdfs(self.exe, self.hdfs_store)
+                mirrors.append(self.generate_store_mirror(self.exe))
             if self.setup_script:
-                log.info('Copying %s -->> %s', self.setup_script, self.hdfs_store)
-                cp_hdfs(self.setup_script, self.hdfs_store)
+                mirrors.append(self.generate_store_mirror(self.setup_script))
+
+        mirrors.extend(m for m in self.common_input_file_mirrors
+                       if not (self.content_store and self.content_store.contains(m)))
+
+        for job in self.jobs.values():
+            mirrors.extend(job.get_files_to_transfer())
+        return mirrors
 
-        # Transfer common input files
-        for ifile in self.common_input_file_mirrors:
-            log.info('Copying %s -->> %s', ifile.original, ifile.hdfs)
-            cp_hdfs(ifile.original, ifile.hdfs)
+    def generate_store_mirror(self, filename):
+        """Make a FileMirror for a file to be stored directly in self.hdfs_store.
 
-        # Get each job to transfer their necessary files
-        for job in self.jobs.itervalues():
-            job.transfer_to_hdfs()
+        Parameters
+        ----------
+        filename : str
+            Filepath of original file.
+
+        Returns
+        -------
+        FileMirror
+        """
+        basename = os.path.basename(filename)
+        return ht.FileMirror(original=filename,
+                             hdfs=os.path.join(self.hdfs_store, basename),
+                             worker=basename)
+
+    def transfer_to_hdfs(self, num_workers=4, batch_size=50, incremental=False):
+        """Copy any necessary input files to HDFS.
 
-    def submit(self, force=False):
+        This transfers both common exe/setup (if self.share_exe_setup == True),
+        and the individual files required by each Job. Files are copied in
+        batches, with several batches running concurrently.
+
+        Parameters
+        ----------
+        num_workers : int, optional
+            Maximum number of copy commands to run concurrently.
+
+        batch_size : int, optional
+            Maximum number of files to copy with a single command.
+
+        incremental : bool, optional
+            If True, skip files that have not changed since they were last
+            copied, according to the manifest next to the HTCondor job file.
+            See generate_manifest_filename().
+        """
+        manifest = TransferManifest(self.generate_manifest_filename()) if incremental else None
+        stager = FileStager(num_workers=num_workers, batch_size=batch_size, manifest=manifest)
+        stager.add_mirrors(self.get_files_to_transfer())
+        stager.transfer()
+
+    def generate_manifest_filename(self):
+        """Get the filename of the manifest of files copied to HDFS.
+
+        Returns
+        -------
+        str
+            Filename, next to the HTCondor job file.
+        """
+        return os.path.splitext(self.filename)[0] + '.transfers.json'
+
+    def submit(self, force=False, incremental=True):
         """Write HTCondor job file, copy necessary files to HDFS, and submit.
         Also prints out info for user.
 
@@ -371,13 +730,17 @@ class JobSet(object):
         force : bool, optional
             Force condor_submit
 
+        incremental : bool, optional
+            If True, only copy files to HDFS that have changed since the last
+            submission. Otherwise all files are copied.
+
         Raises
         ------
         CalledProcessError
             If condor_submit returns non-zero exit code.
         """
         self.write(dag_mode=False)
-        self.transfer_to_hdfs()
+        self.transfer_to_hdfs(incremental=incremental)
 
         cmds = ['condor_submit', self.filename]
         if force:
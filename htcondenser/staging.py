@@ -0,0 +1,398 @@
+"""
+Classes to handle the copying of many files to HDFS before submission.
+"""
+
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from htcondenser.common import (cp_hdfs, cp_hdfs_batch, check_dir_create, check_dirs_create,
+                                file_hash, list_dir, list_dir_status)
+
+
+log = logging.getLogger(__name__)
+
+
+def get_size(path):
+    """Get size of a file, or total size of all files in a directory, in bytes.
+
+    Parameters
+    ----------
+    path : str
+        Filepath of file or directory.
+
+    Returns
+    -------
+    int
+        Size in bytes. 0 if `path` does not exist.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+    return total
+
+
+def same_contents(filename1, filename2):
+    """Check if two local files have identical contents.
+
+    Directories, and files that do not exist, are never identical.
+    """
+    if not (os.path.isfile(filename1) and os.path.isfile(filename2)):
+        return False
+    if os.path.getsize(filename1) != os.path.getsize(filename2):
+        return False
+    return file_hash(filename1) == file_hash(filename2)
+
+
+class FileStager(object):
+    """Collect FileMirrors, and copy their originals to their HDFS location.
+
+    Instead of running one hadoop command per file, mirrors are grouped by
+    their destination directory, and each group is copied in batches of
+    several files per hadoop command. The batches are run concurrently
+    on a bounded pool of threads.
+
+    Parameters
+    ----------
+    num_workers : int, optional
+        Maximum number of copy commands to run concurrently.
+
+    batch_size : int, optional
+        Maximum number of files to copy with a single command.
+
+    force : bool, optional
+        If True, will overwrite destination files if they already exist.
+
+    manifest : TransferManifest, optional
+        Record of previous transfers. If set, any file that has not changed
+        since it was last copied, and whose copy is still on HDFS, is skipped.
+        The manifest is updated and saved after transferring.
+    """
+
+    def __init__(self, num_workers=4, batch_size=50, force=True, manifest=None):
+        super(FileStager, self).__init__()
+        self.num_workers = max(int(num_workers), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self.force = force
+        self.manifest = manifest
+        # Hold FileMirrors to transfer, key is the destination on HDFS.
+        # This ensures a destination is only copied once, even if several
+        # Jobs use it.
+        self.mirrors = OrderedDict()
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    def add_mirror(self, mirror):
+        """Add a FileMirror to be transferred.
+
+        Mirrors where the original is already at the HDFS location are ignored.
+        If several originals mirror to the same location, only the last is
+        copied, with a warning unless their contents are identical (as with
+        a ContentStore blob).
+
+        Parameters
+        ----------
+        mirror : FileMirror
+            FileMirror object, whose original will be copied to its HDFS location.
+        """
+        if mirror.original == mirror.hdfs:
+            return
+        existing = self.mirrors.get(mirror.hdfs)
+        conflict = existing and existing.original != mirror.original
+        if conflict and not same_contents(existing.original, mirror.original):
+            log.warning('%s and %s both mirror to %s - only %s will be copied',
+                        existing.original, mirror.original, mirror.hdfs, mirror.original)
+        self.mirrors[mirror.hdfs] = mirror
+
+    def add_mirrors(self, mirrors):
+        """Add several FileMirrors to be transferred.
+
+        Parameters
+        ----------
+        mirrors : iterable[FileMirror]
+            FileMirror objects, whose originals will be copied to their HDFS locations.
+        """
+        for mirror in mirrors:
+            self.add_mirror(mirror)
+
+    def generate_batches(self):
+        """Split the mirrors into batches, where each batch can be copied by
+        one command.
+
+        Mirrors are grouped by destination directory.
+
+        Returns
+        -------
+        list[list[FileMirror]]
+            Batches of FileMirrors.
+        """
+        groups = OrderedDict()
+        for mirror in self.mirrors.values():
+            groups.setdefault(os.path.dirname(mirror.hdfs), []).append(mirror)
+
+        batches = []
+        for group in groups.values():
+            for i in range(0, len(group), self.batch_size):
+                batches.append(group[i:i + self.batch_size])
+        return batches
+
+    def transfer_batch(self, batch):
+        """Copy one batch of FileMirrors to their HDFS locations.
+
+        A batch copy keeps each file's basename, so if any file has a
+        different name on HDFS, the batch is copied via a temporary directory
+        of symlinks with the HDFS names.
+
+        Parameters
+        ----------
+        batch : list[FileMirror]
+            Batch of FileMirrors, as made by generate_batches().
+
+        Returns
+        -------
+        list[FileMirror], int
+            The batch, and number of bytes copied.
+        """
+        if len(batch) == 1:
+            cp_hdfs(batch[0].original, batch[0].hdfs, self.force)
+        elif all(os.path.basename(m.original) == os.path.basename(m.hdfs) for m in batch):
+            cp_hdfs_batch([m.original for m in batch],
+                          os.path.dirname(batch[0].hdfs), self.force)
+        else:
+            link_dir = tempfile.mkdtemp(prefix='htcondenser_')
+            try:
+                links = []
+                for m in batch:
+                    links.append(os.path.join(link_dir, os.path.basename(m.hdfs)))
+                    os.symlink(os.path.abspath(m.original), links[-1])
+                cp_hdfs_batch(links, os.path.dirname(batch[0].hdfs), self.force)
+            finally:
+                shutil.rmtree(link_dir)
+        return batch, sum(get_size(m.original) for m in batch)
+
+    def remove_unchanged(self):
+        """Remove any mirrors that self.manifest says are unchanged since they
+        were last copied, and whose copy still exists on HDFS.
+
+        Returns
+        -------
+        list[FileMirror]
+            Mirrors that were removed.
+        """
+        if not self.manifest:
+            return []
+        # list each directory once, rather than checking each file separately,
+        # and only for mirrors that the manifest says may be skipped
+        dir_contents = {}
+        unchanged = []
+        for mirror in list(self.mirrors.values()):
+            if not self.manifest.is_unchanged(mirror):
+                continue
+            dest_dir, basename = os.path.split(mirror.hdfs)
+            if dest_dir not in dir_contents:
+                dir_contents[dest_dir] = set(list_dir(dest_dir))
+            if basename in dir_contents[dest_dir]:
+                unchanged.append(self.mirrors.pop(mirror.hdfs))
+        return unchanged
+
+    def transfer(self):
+        """Copy all mirrors to HDFS, logging progress & throughput.
+
+        Destination directories are created if they do not already exist.
+
+        Returns
+        -------
+        int
+            Number of files copied.
+
+        Raises
+        ------
+        CalledProcessError
+            If any of the copy commands fail.
+        """
+        unchanged = self.remove_unchanged()
+        if unchanged:
+            log.info('Skipping %d unchanged files already on HDFS', len(unchanged))
+            for mirror in unchanged:
+                log.debug('Skipping unchanged %s -->> %s', mirror.original, mirror.hdfs)
+
+        batches = self.generate_batches()
+        if not batches:
+            if self.manifest:
+                self.manifest.save()
+            return 0
+
+        check_dirs_create(os.path.dirname(m.hdfs) for m in self.mirrors.values())
+
+        n_total = len(self.mirrors)
+        log.info('Copying %d files to HDFS in %d batches', n_total, len(batches))
+        n_files, n_bytes = 0, 0
+        start = time.time()
+        # imported here, since it is slow to import and only needed for copying
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.num_workers, len(batches)))
+        try:
+            for batch, batch_bytes in pool.imap_unordered(self.transfer_batch, batches):
+                n_files += len(batch)
+                n_bytes += batch_bytes
+                elapsed = max(time.time() - start, 1E-6)
+                log.info('Copied %d/%d files (%.1f MB) in %.1f s, %.2f MB/s',
+                         n_files, n_total, n_bytes / 1E6, elapsed, n_bytes / 1E6 / elapsed)
+                if self.manifest:
+                    for mirror in batch:
+                        self.manifest.record(mirror)
+        finally:
+            pool.close()
+            pool.join()
+            if self.manifest:
+                self.manifest.save()
+        return n_files
+
+
+class ContentStore(object):
+    """Content-addressed store for files on HDFS.
+
+    Each file is stored as a 'blob' in `store_dir`, named after the hash of
+    its contents. Files with identical contents therefore share one blob,
+    and only need copying to HDFS once, even across separate submissions.
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory to hold the blobs.
+    """
+
+    def __init__(self, store_dir):
+        super(ContentStore, self).__init__()
+        self.store_dir = store_dir
+        # Size of each blob already in store_dir, key is blob name.
+        # Only filled when first needed.
+        self._existing_blobs = None
+
+    def generate_blob_path(self, filename):
+        """Get the path of the blob in the store for a file.
+
+        Parameters
+        ----------
+        filename : str
+            Filepath of original file.
+
+        Returns
+        -------
+        str
+            Path of blob.
+        """
+        return os.path.join(self.store_dir, file_hash(filename))
+
+    def contains(self, mirror):
+        """Check if a mirror's blob already exists in the store.
+
+        The blob must be the same size as the original, so that a partial
+        blob, e.g. from an interrupted copy, is copied again.
+        The store's contents are only listed once, so blobs added afterwards
+        are not seen.
+
+        Parameters
+        ----------
+        mirror : FileMirror
+            Mirror of a file, whose HDFS location is a blob path as made by
+            generate_blob_path().
+
+        Returns
+        -------
+        bool
+            True if the blob already exists.
+        """
+        if os.path.dirname(mirror.hdfs) != self.store_dir:
+            return False
+        if self._existing_blobs is None:
+            self._existing_blobs = dict((name, size) for name, (_, size)
+                                        in list_dir_status(self.store_dir).items())
+        size = self._existing_blobs.get(os.path.basename(mirror.hdfs))
+        if size is None or not os.path.isfile(mirror.original):
+            return False
+        return size == os.path.getsize(mirror.original)
+
+
+class TransferManifest(object):
+    """Persistent record of the files copied to HDFS, so that unchanged files
+    do not need copying again on a later submission.
+
+    For each copy on HDFS, stores the original's filepath, size,
+    modification time, and hash. A file is unchanged if its size and
+    modification time match, or if only its modification time differs but
+    its hash matches.
+
+    Parameters
+    ----------
+    filename : str
+        JSON file to hold the manifest. Loaded if it already exists.
+    """
+
+    def __init__(self, filename):
+        super(TransferManifest, self).__init__()
+        self.filename = filename
+        # key is the path on HDFS, value is dict of info about original
+        self.entries = {}
+        if os.path.isfile(self.filename):
+            with open(self.filename) as mfile:
+                self.entries = json.load(mfile)
+
+    def is_unchanged(self, mirror):
+        """Check if a mirror's original has not changed since it was recorded.
+
+        Parameters
+        ----------
+        mirror : FileMirror
+
+        Returns
+        -------
+        bool
+            True if the original is unchanged.
+        """
+        entry = self.entries.get(mirror.hdfs)
+        original = os.path.realpath(mirror.original)
+        if not entry or entry['original'] != original or not os.path.isfile(original):
+            return False
+        stat = os.stat(original)
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime != entry['mtime']:
+            if file_hash(original) != entry['hash']:
+                return False
+            entry['mtime'] = stat.st_mtime
+        return True
+
+    def record(self, mirror):
+        """Record that a mirror's original has been copied to HDFS.
+
+        Directories are not recorded, and so are always copied.
+
+        Parameters
+        ----------
+        mirror : FileMirror
+        """
+        original = os.path.realpath(mirror.original)
+        if not os.path.isfile(original):
+            return
+        stat = os.stat(original)
+        self.entries[mirror.hdfs] = dict(original=original,
+                                         size=stat.st_size,
+                                         mtime=stat.st_mtime,
+                                         hash=file_hash(original))
+
+    def save(self):
+        """Write the manifest to file."""
+        log.debug('Writing transfer manifest to %s', self.filename)
+        check_dir_create(os.path.dirname(os.path.realpath(self.filename)))
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as mfile:
+            json.dump(self.entries, mfile, indent=0, sort_keys=True)
+        os.rename(tmp_filename, self.filename)
@@ -6,11 +6,43 @@ and execution of a job.
 """
 
 
+from __future__ import print_function
 import argparse
-from subprocess import check_call, Popen, PIPE
+from subprocess import check_call, Popen, PIPE, CalledProcessError
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
 import sys
 import shutil
 import os
+import errno
+import fcntl
+import hashlib
+import json
+import math
+import re
+import select
+import tempfile
+import threading
+import time
+
+
+# Marker files for prefetch mode: READY_SUFFIX is appended to each input
+# file's name once it has been copied. STAGEIN_DONE/STAGEIN_FAILED are made
+# once all input files have been copied, or if copying failed.
+READY_SUFFIX = '.ready'
+STAGEIN_DONE = 'stagein.done'
+STAGEIN_FAILED = 'stagein.failed'
+
+# Delay in seconds before the first retry of a failed copy to HDFS.
+# Doubled for each subsequent retry.
+RETRY_DELAY = 5
+
+# For streamed outputs, this many bytes are kept in memory, so that if the
+# stream to HDFS fails within them, the output can still be saved locally
+# and copied afterwards instead.
+STREAM_BUFFER_SIZE = 64 * 1024 * 1024
+STREAM_CHUNK_SIZE = 1024 * 1024
 
 
 class WorkerArgParser(argparse.ArgumentParser):
@@ -32,25 +64,862 @@ class WorkerArgParser(argparse.ArgumentParser):
                           "after running program. "
                           "Must be of the form <source> <destination>. "
                           "Repeat for each file you want to copy.")
+        self.add_argument("--copyToLocalCached", nargs=2, action='append',
+                          help="Like --copyToLocal, but for files shared by many "
+                          "jobs, that are kept in a cache on the worker node "
+                          "if --cacheDir is set.")
+        self.add_argument("--cacheDir",
+                          help="Directory on the worker node to cache files "
+                          "from --copyToLocalCached. Shared between jobs.")
+        self.add_argument("--cacheMaxSize", default='10GB',
+                          help="Maximum total size of files in --cacheDir, "
+                          "e.g. 10GB. Least recently used files are removed "
+                          "to keep under this.")
+        self.add_argument("--streamFromLocal", nargs=2, action='append',
+                          help="Like --copyFromLocal, but the file is streamed "
+                          "to HDFS while the program writes it, via a named pipe. "
+                          "Falls back to copying afterwards if streaming fails. "
+                          "Only for destinations on HDFS, and files written "
+                          "sequentially.")
+        self.add_argument("--copyWorkers", type=int, default=4,
+                          help="Maximum number of copy commands to run concurrently.")
+        self.add_argument("--copyRetries", type=int, default=3,
+                          help="Number of times to retry a failed copy to HDFS.")
+        self.add_argument("--prefetch", type=int,
+                          help="Start the executable once this many input files "
+                          "(plus executable & setup script) have been copied, "
+                          "and copy the rest in the background. Input files are "
+                          "marked as ready by making a file with the same name "
+                          "+ '%s'." % READY_SUFFIX)
+        self.add_argument("--report",
+                          help="Where to save a JSON report of timings, files "
+                          "copied, and resources used. {cluster} and {process} "
+                          "are replaced by the job's cluster and process IDs.")
         self.add_argument("--exe", help="Name of executable")
         self.add_argument("--args", nargs=argparse.REMAINDER,
                           help="Args to pass to executable")
 
 
+def get_size(path):
+    """Get size of a file, or total size of all files in a directory, in bytes."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+    return total
+
+
+def make_batches(pairs, num_batches):
+    """Split (source, destination) pairs into at most `num_batches` batches of
+    similar size, such that no batch has two sources with the same basename."""
+    if not pairs:
+        return []
+    batch_size = int(math.ceil(len(pairs) / float(num_batches)))
+    batches = []  # each entry is (list of pairs, set of source basenames)
+    for source, dest in pairs:
+        name = os.path.basename(source.rstrip('/'))
+        for batch, names in batches:
+            if len(batch) < batch_size and name not in names:
+                batch.append((source, dest))
+                names.add(name)
+                break
+        else:
+            batches.append(([(source, dest)], set([name])))
+    return [batch for batch, _ in batches]
+
+
+def copy_hdfs_to_local(batch):
+    """Copy a batch of (source, destination) pairs from HDFS with one hadoop
+    command.
+
+    Sources are copied into a staging directory, then moved to their
+    destinations, since the destinations may not have the same basenames.
+    This also ensures a destination only appears once it is complete.
+
+    Returns
+    -------
+    list[(str, str, int)], float
+        (source, destination, bytes) for each pair, and time taken in seconds.
+    """
+    start = time.time()
+    stage_dir = tempfile.mkdtemp(prefix='.stagein_', dir=os.getcwd())
+    try:
+        sources = [source.replace('/hdfs', '', 1) for source, _ in batch]
+        check_call(['hadoop', 'fs', '-copyToLocal'] + sources + [stage_dir])
+        results = []
+        for source, dest in batch:
+            dest_dir = os.path.dirname(dest)
+            if dest_dir and not os.path.isdir(dest_dir):
+                os.makedirs(dest_dir)
+            os.rename(os.path.join(stage_dir, os.path.basename(source.rstrip('/'))), dest)
+            results.append((source, dest, get_size(dest)))
+    finally:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+    return results, time.time() - start
+
+
+def copy_to_local(batch):
+    """Copy a batch of (source, destination) pairs not on HDFS, one at a time.
+
+    Returns
+    -------
+    list[(str, str, int)], float
+        (source, destination, bytes) for each pair, and time taken in seconds.
+        bytes is None if the source does not exist.
+    """
+    start = time.time()
+    results = []
+    for source, dest in batch:
+        if os.path.isfile(source):
+            shutil.copy2(source, dest)
+        elif os.path.isdir(source):
+            shutil.copytree(source, dest)
+        else:
+            results.append((source, dest, None))
+            continue
+        results.append((source, dest, get_size(dest)))
+    return results, time.time() - start
+
+
+def _run_copy(task):
+    """Run a (copy function, batch) task, for use with a pool."""
+    func, batch = task
+    return func(batch)
+
+
+def stage_in(pairs, num_workers=4, num_batches=None, mark_ready=False):
+    """Copy (source, destination) pairs to the worker node.
+
+    Sources on HDFS are grouped into a few multi-file hadoop commands, and
+    all copies are run concurrently on a pool of at most `num_workers`
+    threads. Prints the bytes and time taken for each file.
+
+    Parameters
+    ----------
+    pairs : list[(str, str)]
+        (source, destination) pairs.
+
+    num_workers : int, optional
+        Maximum number of copies to run concurrently.
+
+    num_batches : int, optional
+        Number of batches to split sources on HDFS into. Defaults to
+        `num_workers`. Batches are started in order, so more, smaller
+        batches mean the first files are ready sooner.
+
+    mark_ready : bool, optional
+        If True, make a marker file (destination + READY_SUFFIX) once each
+        destination is complete.
+
+    Returns
+    -------
+    list[(str, str, int, float)]
+        (source, destination, bytes, seconds) for each file copied.
+    """
+    num_workers = max(num_workers, 1)
+    hdfs_pairs = [p for p in pairs if p[0].startswith('/hdfs')]
+    other_pairs = [p for p in pairs if not p[0].startswith('/hdfs')]
+    batches = make_batches(hdfs_pairs, num_batches or num_workers)
+    tasks = [(copy_to_local, [pair]) for pair in other_pairs]
+    tasks.extend((copy_hdfs_to_local, batch) for batch in batches)
+    if not tasks:
+        return []
+    start = time.time()
+    copied = []
+    total_bytes = 0
+    pool = ThreadPool(min(num_workers, len(tasks)))
+    try:
+        for results, elapsed in pool.imap_unordered(_run_copy, tasks):
+            for source, dest, n_bytes in results:
+                if n_bytes is None:
+                    print('File {0} does not exist - cannot copy to {1}'.format(source, dest))
+                    continue
+                copied.append((source, dest, n_bytes, elapsed))
+                total_bytes += n_bytes
+                if mark_ready:
+                    open(dest + READY_SUFFIX, 'w').close()
+                print('Copied {0} -> {1}: {2} bytes in {3:.2f} s{4}'.format(
+                    source, dest, n_bytes, elapsed,
+                    ' (batch of %d)' % len(results) if len(results) > 1 else ''))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    print('Stage-in: {0} files, {1} bytes in {2:.2f} s'.format(len(copied), total_bytes, elapsed))
+    return copied
+
+
+def get_hdfs_size(path):
+    """Get size of a file or directory on HDFS, in bytes.
+
+    Uses the /hdfs mount if available, otherwise asks hadoop.
+    """
+    if os.path.exists(path):
+        return get_size(path)
+    proc = Popen(['hadoop', 'fs', '-du', '-s', path.replace('/hdfs', '', 1)],
+                 stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(err)
+    return int(out.split()[0])
+
+
+def make_hdfs_dirs(directories):
+    """Make any directories on HDFS that do not exist, with one command."""
+    missing = sorted(set(d for d in directories if not os.path.exists(d)))
+    if missing:
+        check_call(['hdfs', 'dfs', '-mkdir', '-p'] + [d.replace('/hdfs', '', 1) for d in missing])
+
+
+def copy_from_local(pair, retries=3):
+    """Copy a (source, destination) pair from the worker node.
+
+    Copies to HDFS have their size checked afterwards, and are retried with
+    increasing delays if the copy fails or the size is wrong. A directory
+    already at the destination (e.g. from an earlier attempt) is removed
+    first, since hadoop would otherwise copy into it.
+
+    Returns
+    -------
+    list[(str, str, int)], float
+        (source, destination, bytes), and time taken in seconds.
+    """
+    source, dest = pair
+    start = time.time()
+    n_bytes = get_size(source)
+    if not dest.startswith('/hdfs'):
+        if os.path.isfile(source):
+            shutil.copy2(source, dest)
+        elif os.path.isdir(source):
+            shutil.copytree(source, dest)
+        return [(source, dest, n_bytes)], time.time() - start
+
+    hdfs_dest = dest.replace('/hdfs', '', 1)
+    attempt = 0
+    while True:
+        try:
+            if os.path.isdir(source):
+                check_call(['hadoop', 'fs', '-rm', '-r', '-f', hdfs_dest])
+            check_call(['hadoop', 'fs', '-copyFromLocal', '-f', os.path.realpath(source),
+                        hdfs_dest])
+            hdfs_bytes = get_hdfs_size(dest)
+            if hdfs_bytes != n_bytes:
+                raise RuntimeError('Size of {0} on HDFS is {1} bytes, expected {2}'.format(
+                                   dest, hdfs_bytes, n_bytes))
+            return [(source, dest, n_bytes)], time.time() - start
+        except Exception as err:
+            if attempt >= retries:
+                raise
+            delay = RETRY_DELAY * 2 ** attempt
+            attempt += 1
+            print('Copying {0} to {1} failed ({2}), retry {3}/{4} in {5} s'.format(
+                source, dest, err, attempt, retries, delay))
+            time.sleep(delay)
+
+
+def stage_out(pairs, num_workers=4, retries=3):
+    """Copy (source, destination) pairs from the worker node.
+
+    All destination directories on HDFS are made first, then files are
+    copied concurrently on a pool of at most `num_workers` threads.
+    Sources that do not exist are skipped. Prints the bytes and time
+    taken for each file.
+
+    Returns
+    -------
+    list[(str, str, int, float)]
+        (source, destination, bytes, seconds) for each file copied.
+    """
+    existing = []
+    for source, dest in pairs:
+        if os.path.exists(source):
+            existing.append((source, dest))
+        else:
+            print('File {0} does not exist - cannot copy to {1}'.format(source, dest))
+    if not existing:
+        return []
+    make_hdfs_dirs(os.path.dirname(dest) for _, dest in existing if dest.startswith('/hdfs'))
+
+    start = time.time()
+    copied = []
+    total_bytes = 0
+    pool = ThreadPool(min(max(num_workers, 1), len(existing)))
+    try:
+        for results, elapsed in pool.imap_unordered(
+                lambda pair: copy_from_local(pair, retries), existing):
+            for source, dest, n_bytes in results:
+                copied.append((source, dest, n_bytes, elapsed))
+                total_bytes += n_bytes
+                print('Copied {0} -> {1}: {2} bytes in {3:.2f} s'.format(
+                    source, dest, n_bytes, elapsed))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    print('Stage-out: {0} files, {1} bytes in {2:.2f} s'.format(len(copied), total_bytes, elapsed))
+    return copied
+
+
+class OutputStreamer(threading.Thread):
+    """Thread to stream an output file to HDFS while the executable writes it.
+
+    A named pipe is made at the output file's location. Everything written
+    to it is passed to `hadoop fs -put`, until finish() is called after the
+    executable has exited. If streaming fails within the first
+    STREAM_BUFFER_SIZE bytes, the output is saved to a local spool file
+    instead, to be copied afterwards (see result()).
+
+    The pipe is held open for writing by this thread as well, so the
+    executable may open and close it several times, and this thread is not
+    left waiting if the executable never opens it.
+
+    Parameters
+    ----------
+    source : str
+        Output file on worker node, written by executable.
+
+    dest : str
+        Destination on HDFS.
+    """
+    def __init__(self, source, dest):
+        super(OutputStreamer, self).__init__()
+        self.daemon = True
+        self.source = source
+        self.dest = dest
+        self.spool = source + '.spool'
+        self.n_bytes = 0
+        self.elapsed = 0
+        self.finishing = False  # set once the executable has exited
+        self.spooled = False  # whether output was saved to self.spool
+        self.error = None  # set if streaming failed and output was lost
+        source_dir = os.path.dirname(source)
+        if source_dir and not os.path.isdir(source_dir):
+            os.makedirs(source_dir)
+        os.mkfifo(source)
+        # Linux allows a pipe to be opened for reading & writing without blocking
+        self.fd = os.open(source, os.O_RDWR)
+
+    def run(self):
+        try:
+            self._stream()
+        except Exception as err:
+            self.error = err
+        finally:
+            os.close(self.fd)
+
+    def _read_chunks(self):
+        """Yield chunks from the pipe until finish() is called and it is empty."""
+        while True:
+            readable, _, _ = select.select([self.fd], [], [], 0.5)
+            if readable:
+                yield os.read(self.fd, STREAM_CHUNK_SIZE)
+            elif self.finishing:
+                return
+
+    def _stream(self):
+        start = time.time()
+        proc, buffered, spool = None, [], None
+        for chunk in self._read_chunks():
+            self.n_bytes += len(chunk)
+            if spool or self.error:
+                if spool:
+                    spool.write(chunk)
+                continue  # keep reading, so the executable is not blocked
+            if buffered is not None:
+                buffered.append(chunk)
+                if self.n_bytes > STREAM_BUFFER_SIZE:
+                    buffered = None
+            try:
+                if proc is None:
+                    proc = Popen(['hadoop', 'fs', '-put', '-f', '-',
+                                  self.dest.replace('/hdfs', '', 1)], stdin=PIPE)
+                proc.stdin.write(chunk)
+            except (IOError, OSError) as err:
+                spool = self._fail(err, buffered, proc)
+                proc = None
+        if proc:
+            try:
+                proc.stdin.close()
+            except IOError:
+                pass
+            if proc.wait() != 0:
+                spool = self._fail('hadoop returned %d' % proc.returncode, buffered, None)
+            elif get_hdfs_size(self.dest) != self.n_bytes:
+                spool = self._fail('size on HDFS does not match', buffered, None)
+        if spool:
+            spool.close()
+        self.elapsed = time.time() - start
+
+    def _fail(self, err, buffered, proc):
+        """Handle a failure to stream. Returns an open spool file if the
+        output so far is still in `buffered`, otherwise sets self.error."""
+        print('Streaming {0} to {1} failed: {2}'.format(self.source, self.dest, err))
+        if proc:
+            proc.kill()
+            proc.wait()
+        if buffered is None:
+            self.error = RuntimeError('Streaming {0} to {1} failed after {2} bytes'.format(
+                                      self.source, self.dest, self.n_bytes))
+            return None
+        print('Saving {0} locally instead'.format(self.source))
+        self.spooled = True
+        spool = open(self.spool, 'wb')
+        for chunk in buffered:
+            spool.write(chunk)
+        return spool
+
+    def finish(self):
+        """Tell the thread the executable has exited, and wait for it to
+        stream the rest of the output."""
+        self.finishing = True
+        self.join()
+
+    def result(self):
+        """Get the outcome of streaming, once the thread has finished.
+
+        Returns
+        -------
+        str, tuple
+            'streamed' with (source, destination, bytes, seconds), or
+            'copy' with the (local file, destination) pair to copy instead,
+            or 'missing' with (source, destination) if nothing was written.
+
+        Raises
+        ------
+        RuntimeError
+            If streaming failed and the output could not be saved.
+        """
+        if self.error:
+            raise self.error
+        if self.spooled:
+            return 'copy', (self.spool, self.dest)
+        if self.n_bytes == 0:
+            # the executable may have replaced the pipe with a normal file
+            if os.path.isfile(self.source):
+                return 'copy', (self.source, self.dest)
+            return 'missing', (self.source, self.dest)
+        return 'streamed', (self.source, self.dest, self.n_bytes, self.elapsed)
+
+
+def start_streams(pairs):
+    """Start an OutputStreamer for each (source, destination) pair.
+
+    Pairs that cannot be streamed are returned to be copied afterwards.
+
+    Returns
+    -------
+    list[OutputStreamer], list[(str, str)]
+        Started streamers, and pairs to copy instead.
+    """
+    streamers, to_copy = [], []
+    make_hdfs_dirs(os.path.dirname(dest) for _, dest in pairs if dest.startswith('/hdfs'))
+    for source, dest in pairs:
+        if not dest.startswith('/hdfs'):
+            to_copy.append((source, dest))
+            continue
+        try:
+            streamer = OutputStreamer(source, dest)
+        except OSError as err:
+            print('Cannot stream {0}: {1}'.format(source, err))
+            to_copy.append((source, dest))
+            continue
+        streamer.start()
+        streamers.append(streamer)
+    return streamers, to_copy
+
+
+def finish_streams(streamers):
+    """Wait for all OutputStreamers to finish.
+
+    Returns
+    -------
+    list[(str, str, int, float)], list[(str, str)]
+        (source, destination, bytes, seconds) for each file streamed, and
+        (local file, destination) pairs that need copying instead.
+    """
+    streamed, to_copy = [], []
+    for streamer in streamers:
+        streamer.finish()
+        outcome, info = streamer.result()
+        if outcome == 'streamed':
+            print('Streamed {0} -> {1}: {2} bytes in {3:.2f} s'.format(*info))
+            streamed.append(info)
+        elif outcome == 'copy':
+            to_copy.append(info)
+        else:
+            print('File {0} was not written - cannot stream to {1}'.format(*info))
+    return streamed, to_copy
+
+
+def split_prefetch(pairs, num_first, always_first):
+    """Split (source, destination) pairs into those to copy before running
+    the executable, and those to copy in the background.
+
+    Parameters
+    ----------
+    pairs : list[(str, str)]
+        (source, destination) pairs, in the order the executable uses them.
+
+    num_first : int
+        Number of pairs to copy first, not counting those in `always_first`.
+
+    always_first : list[str]
+        Destinations that are always copied first, e.g. executable.
+
+    Returns
+    -------
+    list[(str, str)], list[(str, str)]
+        Pairs to copy first, and pairs to copy in the background.
+    """
+    first = [p for p in pairs if p[1] in always_first]
+    rest = [p for p in pairs if p[1] not in always_first]
+    return first + rest[:num_first], rest[num_first:]
+
+
+class BackgroundStageIn(threading.Thread):
+    """Thread to copy input files while the executable is running.
+
+    Makes the marker file STAGEIN_DONE once all files are copied, or
+    STAGEIN_FAILED if copying fails, in which case the exception is
+    stored in `error`.
+    """
+    def __init__(self, pairs, num_workers):
+        super(BackgroundStageIn, self).__init__()
+        self.daemon = True
+        self.pairs = pairs
+        self.num_workers = num_workers
+        self.error = None
+        self.copied = []
+
+    def run(self):
+        try:
+            # Use smaller batches, so that early files are ready sooner
+            self.copied = stage_in(self.pairs, self.num_workers,
+                                   num_batches=min(len(self.pairs), 4 * self.num_workers),
+                                   mark_ready=True)
+            open(STAGEIN_DONE, 'w').close()
+        except Exception as err:
+            print('Background copy failed:', err)
+            self.error = err
+            open(STAGEIN_FAILED, 'w').close()
+
+
+def parse_size(size):
+    """Convert a size string e.g. '10GB', '500M', or '1024' to bytes."""
+    match = re.match(r'^\s*([\d.]+)\s*([KMGT]?)i?B?\s*$', str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError('Cannot understand size {0}'.format(size))
+    power = ['', 'K', 'M', 'G', 'T'].index(match.group(2).upper())
+    return int(float(match.group(1)) * 1024 ** power)
+
+
+def get_cache_keys(sources):
+    """Get a key for the contents of each file, without reading them.
+
+    Files on /hdfs are keyed by their HDFS checksum, so files with the
+    same contents share a key. These come from one `hadoop fs -checksum`
+    call per batch of files, rather than one call per file. Other files
+    are keyed by their path, size, and modification time.
+
+    Returns
+    -------
+    dict
+        {source: key}. Sources that cannot be found, or have no HDFS
+        checksum (e.g. directories), are left out.
+    """
+    keys = {}
+    hdfs_paths = OrderedDict()
+    for source in sources:
+        if source.startswith('/hdfs'):
+            hdfs_paths[source.replace('/hdfs', '', 1)] = source
+        elif os.path.exists(source):
+            key = '{0}:{1}:{2}'.format(source, get_size(source), int(os.path.getmtime(source)))
+            keys[source] = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    paths = list(hdfs_paths)
+    for i in range(0, len(paths), 500):
+        proc = Popen(['hadoop', 'fs', '-checksum'] + paths[i:i + 500],
+                     stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        out, _ = proc.communicate()
+        # hadoop fails if any path has no checksum, but still lists the rest
+        for line in out.splitlines():
+            fields = line.split('\t')
+            if len(fields) != 3:
+                continue
+            path = re.sub(r'^\w+://[^/]*', '', fields[0])  # drop hdfs://namenode
+            if path in hdfs_paths:
+                key = 'checksum:{0}:{1}'.format(fields[1], fields[2])
+                keys[hdfs_paths[path]] = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return keys
+
+
+class NodeCache(object):
+    """Cache of input files shared between jobs on the same worker node.
+
+    Each file is stored once in `cache_dir`, named after its cache key,
+    and linked into a job's directory. A job holds a shared lock on each
+    entry it uses until release(), and only takes an exclusive lock to
+    fill a missing entry, so concurrent jobs wanting the same file only
+    download it once, and evict() never removes an entry still in use.
+    Entries are made read-only, since they are hard linked where possible.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory to hold cached files. Must be writable.
+
+    max_size : int
+        Maximum total size of cached files in bytes. Least recently used
+        entries are removed by evict().
+    """
+
+    LOCK_SUFFIX = '.lock'
+
+    def __init__(self, cache_dir, max_size):
+        super(NodeCache, self).__init__()
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self._in_use = []
+        self._in_use_lock = threading.Lock()
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        if not os.access(self.cache_dir, os.W_OK | os.X_OK):
+            raise OSError(errno.EACCES, 'Cannot write to cache directory', self.cache_dir)
+
+    @contextmanager
+    def lock(self, name, blocking=True):
+        """Hold an exclusive lock on `name` in the cache.
+
+        Yields True if the lock was acquired, False if `blocking` is False
+        and another process holds it.
+        """
+        with open(os.path.join(self.cache_dir, name + self.LOCK_SUFFIX), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except IOError as err:
+                if err.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def acquire(self, key, source):
+        """Fill the entry for `key` from `source` if it is missing, and keep
+        a shared lock on it until release().
+
+        Returns
+        -------
+        str, int
+            Path to the entry, and bytes downloaded (0 if already cached).
+        """
+        entry = os.path.join(self.cache_dir, key)
+        lock_file = open(entry + self.LOCK_SUFFIX, 'a')
+        n_bytes = 0
+        try:
+            while True:
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+                if os.path.exists(entry):
+                    break
+                # Converting the lock is not atomic, so another job may fill
+                # (or evict) the entry in between: check again each time.
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if not os.path.exists(entry):
+                    tmp_entry = entry + '.tmp{0}'.format(os.getpid())
+                    if source.startswith('/hdfs'):
+                        copy_hdfs_to_local([(source, tmp_entry)])
+                    else:
+                        copy_to_local([(source, tmp_entry)])
+                    if os.path.isfile(tmp_entry):
+                        os.chmod(tmp_entry, 0o444)
+                    os.rename(tmp_entry, entry)
+                    n_bytes = get_size(entry)
+            os.utime(entry, None)  # mark as recently used
+        except BaseException:
+            lock_file.close()
+            raise
+        with self._in_use_lock:
+            self._in_use.append(lock_file)
+        return entry, n_bytes
+
+    def release(self):
+        """Release the entries used by this job, so evict() can remove them."""
+        with self._in_use_lock:
+            for lock_file in self._in_use:
+                lock_file.close()
+            self._in_use = []
+
+    def fetch_one(self, item):
+        """Copy a (source, destination, key) item via the cache.
+
+        Falls back to a normal copy if there is no key for the source, or
+        the cache cannot be used for it.
+
+        Returns
+        -------
+        list[(str, str, int)], float
+            (source, destination, bytes), and time taken in seconds.
+            bytes is 0 if the file was already in the cache.
+        """
+        source, dest, key = item
+        start = time.time()
+        if key is not None:
+            try:
+                entry, n_bytes = self.acquire(key, source)
+            except (IOError, OSError) as err:
+                print('Cannot cache {0}, copying directly: {1}'.format(source, err))
+            else:
+                if os.path.lexists(dest):
+                    if os.path.isdir(dest) and not os.path.islink(dest):
+                        shutil.rmtree(dest)
+                    else:
+                        os.remove(dest)
+                try:
+                    os.link(entry, dest)
+                except OSError:
+                    os.symlink(entry, dest)
+                return [(source, dest, n_bytes)], time.time() - start
+        pair = (source, dest)
+        return copy_hdfs_to_local([pair]) if source.startswith('/hdfs') else copy_to_local([pair])
+
+    def fetch(self, pairs, num_workers=4, mark_ready=False):
+        """Copy (source, destination) pairs via the cache, concurrently.
+
+        Returns
+        -------
+        list[(str, str, int, float)]
+            (source, destination, bytes downloaded, seconds) for each file.
+        """
+        if not pairs:
+            return []
+        keys = get_cache_keys([source for source, _ in pairs])
+        items = [(source, dest, keys.get(source)) for source, dest in pairs]
+        fetched = []
+        pool = ThreadPool(min(max(num_workers, 1), len(items)))
+        try:
+            for results, elapsed in pool.imap_unordered(self.fetch_one, items):
+                for source, dest, n_bytes in results:
+                    fetched.append((source, dest, n_bytes, elapsed))
+                    if mark_ready:
+                        open(dest + READY_SUFFIX, 'w').close()
+                    print('Cached {0} -> {1}: {2} in {3:.2f} s'.format(
+                        source, dest, '%d bytes' % n_bytes if n_bytes else 'hit', elapsed))
+        finally:
+            pool.close()
+            pool.join()
+        return fetched
+
+    def evict(self):
+        """Remove least recently used entries until the cache is under its
+        maximum size. Entries in use or being filled by a job are skipped."""
+        with self.lock('evict'):
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if name.endswith(self.LOCK_SUFFIX) or '.tmp' in name:
+                    continue
+                entries.append((os.path.getmtime(path), get_size(path), name))
+            total = sum(e[1] for e in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_size:
+                    break
+                with self.lock(name, blocking=False) as locked:
+                    if not locked:
+                        continue
+                    path = os.path.join(self.cache_dir, name)
+                    print('Removing {0} ({1} bytes) from cache'.format(name, size))
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                    total -= size
+
+
+def read_job_ad():
+    """Read this job's HTCondor ClassAd, if available.
+
+    Returns
+    -------
+    dict
+        Attribute names & values, as strings.
+    """
+    job_ad = {}
+    ad_filename = os.environ.get('_CONDOR_JOB_AD')
+    if ad_filename and os.path.isfile(ad_filename):
+        with open(ad_filename) as ad_file:
+            for line in ad_file:
+                key, _, value = line.partition('=')
+                job_ad[key.strip()] = value.strip().strip('"')
+    return job_ad
+
+
+def run_exe(cmd):
+    """Run a shell command, and get its exit code and resource usage.
+
+    Returns
+    -------
+    int, resource.struct_rusage
+        Exit code (negative signal number if killed by a signal), and
+        resource usage of the command and its children.
+    """
+    proc = Popen(cmd, shell=True)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFEXITED(status):
+        proc.returncode = os.WEXITSTATUS(status)
+    else:
+        proc.returncode = -os.WTERMSIG(status)
+    return proc.returncode, rusage
+
+
+def file_records(copied):
+    """Convert (source, destination, bytes, seconds) tuples to dicts for a report."""
+    return [dict(source=source, dest=dest, bytes=n_bytes, seconds=round(elapsed, 3))
+            for source, dest, n_bytes, elapsed in copied]
+
+
+def write_report(report, dest, retries=3):
+    """Write a report dict as JSON to the worker node, then copy it to `dest`."""
+    filename = 'condor_worker_report.json'
+    with open(filename, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    if dest.startswith('/hdfs'):
+        make_hdfs_dirs([os.path.dirname(dest)])
+        copy_from_local((filename, dest), retries)
+    else:
+        shutil.copy2(filename, dest)
+    print('Saved report to', dest)
+
+
 def run_job(in_args=sys.argv[1:]):
     """Main function to run commands on worker node."""
-    print '>>>> condor_worker.py logging:'
-    proc = Popen(['hostname', '-f'], stdout=PIPE, stderr=PIPE)
+    start_time = time.time()
+    timings = OrderedDict()
+    print('>>>> condor_worker.py logging:')
+    proc = Popen(['hostname', '-f'], stdout=PIPE, stderr=PIPE, universal_newlines=True)
     out, err = proc.communicate()
     if err == '':
-        print 'Running on', out
+        print('Running on', out)
     else:
         raise RuntimeError(err)
 
     parser = WorkerArgParser(description=__doc__)
     args = parser.parse_args(in_args)
-    print 'Args:'
-    print args
+    print('Args:')
+    print(args)
+
+    job_ad = read_job_ad()
+    report = dict(hostname=out.strip(), start_time=start_time,
+                  cluster=job_ad.get('ClusterId'), process=job_ad.get('ProcId'),
+                  request_cpus=job_ad.get('RequestCpus'),
+                  request_memory_mb=job_ad.get('RequestMemory'),
+                  request_disk_kb=job_ad.get('RequestDisk'),
+                  exe=args.exe, args=args.args, exit_code=None,
+                  timings=timings, files=dict(stage_in=[], cached=[], streamed=[], stage_out=[]))
 
     # Make sandbox area to avoid names clashing, and stop auto transfer
     # back to submission node
@@ -58,37 +927,66 @@ def run_job(in_args=sys.argv[1:]):
     tmp_dir = 'scratch'
     os.mkdir(tmp_dir)
     os.chdir(tmp_dir)
+    background = None
+    streamers = []
+    cache = None
     try:
+        timings['setup'] = time.time() - start_time
         # Copy files to worker node area from /users, /hdfs, /storage, etc.
+        # In prefetch mode, only copy the first few before running the exe.
         # ---------------------------------------------------------------------
-        if args.copyToLocal:
-            print 'PRE EXECUTION: Copy to local:'
-            for (source, dest) in args.copyToLocal:
-                print source, dest
-                if source.startswith('/hdfs'):
-                    source = source.replace('/hdfs', '')
-                    check_call(['hadoop', 'fs', '-copyToLocal', source, dest])
+        input_pairs = (args.copyToLocal or [])[:]
+        if args.copyToLocalCached:
+            if args.cacheDir:
+                try:
+                    cache = NodeCache(args.cacheDir, parse_size(args.cacheMaxSize))
+                except (IOError, OSError) as err:
+                    print('Cannot use cache, copying directly:', err)
+            if cache:
+                print('PRE EXECUTION: Copy to local via cache:')
+                report['files']['cached'] = file_records(cache.fetch(
+                    args.copyToLocalCached, args.copyWorkers,
+                    mark_ready=args.prefetch is not None))
+                try:
+                    cache.evict()
+                except (IOError, OSError) as err:
+                    print('Could not evict from cache:', err)
+            else:
+                input_pairs.extend(args.copyToLocalCached)
+
+        if input_pairs:
+            print('PRE EXECUTION: Copy to local:')
+            if args.prefetch is None:
+                copied = stage_in(input_pairs, args.copyWorkers)
+            else:
+                first, rest = split_prefetch(input_pairs, args.prefetch,
+                                             [args.exe, args.setup])
+                copied = stage_in(first, args.copyWorkers, mark_ready=True)
+                if rest:
+                    print('Copying {0} more files in background'.format(len(rest)))
+                    background = BackgroundStageIn(rest, args.copyWorkers)
+                    background.start()
                 else:
-                    if os.path.isfile(source):
-                        shutil.copy2(source, dest)
-                    elif os.path.isdir(source):
-                        shutil.copytree(source, dest)
+                    open(STAGEIN_DONE, 'w').close()
+
+            report['files']['stage_in'] = file_records(copied)
+        timings['stage_in'] = time.time() - start_time - sum(timings.values())
 
-        print 'In current dir:'
-        print os.listdir(os.getcwd())
+        print('In current dir:')
+        print(os.listdir(os.getcwd()))
 
         # Do setup of programs & libs, and run the program
         # We have to do this in one step to avoid different-shell-weirdness,
         # since env vars don't necessarily get carried over.
         # ---------------------------------------------------------------------
-        print 'SETUP AND EXECUTION'
+        print('SETUP AND EXECUTION')
         setup_cmd = ''
         if args.setup:
-            os.chmod(args.setup, 0555)
+            os.chmod(args.setup, 0o555)
             setup_cmd = 'source ./' + args.setup + ' && '
 
         if os.path.isfile(os.path.basename(args.exe)):
-            os.chmod(os.path.basename(args.exe), 0555)
+            os.chmod(os.path.basename(args.exe), 0o555)
 
         # run_cmd = args.exe
 
@@ -98,42 +996,76 @@ def run_job(in_args=sys.argv[1:]):
         run_cmd = "if [[ -e {exe} ]];then ./{exe} {args};else {exe} {args};fi"
         run_args = ' '.join(args.args) if args.args else ''
         run_cmd = run_cmd.format(exe=args.exe, args=run_args)
-        print 'Contents of dir before running:'
-        print os.listdir(os.getcwd())
-        print "Running:", setup_cmd + run_cmd
-        check_call(setup_cmd + run_cmd, shell=True)
+        output_pairs = (args.copyFromLocal or [])[:]
+        if args.streamFromLocal:
+            print('Streaming outputs to HDFS:')
+            streamers, to_copy = start_streams(args.streamFromLocal)
+            output_pairs.extend(to_copy)
+
+        print('Contents of dir before running:')
+        print(os.listdir(os.getcwd()))
+        print("Running:", setup_cmd + run_cmd)
+        exe_start = time.time()
+        exit_code, rusage = run_exe(setup_cmd + run_cmd)
+        timings['execution'] = time.time() - exe_start
+        report['exit_code'] = exit_code
+        report['exe_resources'] = dict(max_rss_kb=rusage.ru_maxrss,
+                                       user_cpu_s=round(rusage.ru_utime, 3),
+                                       system_cpu_s=round(rusage.ru_stime, 3))
+        report['scratch_bytes'] = get_size(os.getcwd())
+        if exit_code != 0:
+            raise CalledProcessError(exit_code, setup_cmd + run_cmd)
+
+        stage_out_start = time.time()
+        if background:
+            background.join()
+            report['files']['stage_in'].extend(file_records(background.copied))
+            if background.error:
+                raise background.error
 
-        print 'In current dir:'
-        print os.listdir(os.getcwd())
+        if streamers:
+            streamed, to_copy = finish_streams(streamers)
+            streamers = []
+            report['files']['streamed'] = file_records(streamed)
+            output_pairs.extend(to_copy)
+
+        print('In current dir:')
+        print(os.listdir(os.getcwd()))
 
         # Copy files from worker node area to /hdfs or /storage
         # ---------------------------------------------------------------------
-        if args.copyFromLocal:
-            print 'POST EXECUTION: Copy to HDFS:'
-            for (source, dest) in args.copyFromLocal:
-                print source, dest
-                if not os.path.exists(source):
-                    print 'File {0} does not exist - cannot copy to {1}'.format(source, dest)
-                else:
-                    if dest.startswith('/hdfs'):
-                        source = os.path.realpath(source)
-                        dest_folder = os.path.dirname(dest)
-                        if not os.path.exists(dest_folder):
-                            dest_folder = dest_folder.replace('/hdfs', '')
-                            check_call(['hdfs', 'dfs', '-mkdir', '-p',dest_folder])
-                        dest = dest.replace('/hdfs', '')
-                        check_call(['hadoop', 'fs', '-copyFromLocal', '-f', source, dest])
-                    else:
-                        if os.path.isfile(source):
-                            shutil.copy2(source, dest)
-                        elif os.path.isdir(source):
-                            shutil.copytree(source, dest)
+        if output_pairs:
+            print('POST EXECUTION: Copy to HDFS:')
+            report['files']['stage_out'] = file_records(
+                stage_out(output_pairs, args.copyWorkers, args.copyRetries))
+        timings['stage_out'] = time.time() - stage_out_start
+        report['status'] = 'success'
+    except Exception as err:
+        report['status'] = 'failed'
+        report['error'] = str(err)
+        raise
     finally:
         # Cleanup
         # ---------------------------------------------------------------------
-        print 'CLEANUP'
+        if background:
+            background.join()
+        for streamer in streamers:
+            streamer.finish()
+        if args.report:
+            timings['total'] = time.time() - start_time
+            for key in timings:
+                timings[key] = round(timings[key], 3)
+            try:
+                write_report(report, args.report.format(cluster=report['cluster'] or 'local',
+                                                        process=report['process'] or '0'),
+                             args.copyRetries)
+            except Exception as err:
+                print('Could not save report:', err)
+        print('CLEANUP')
         os.chdir('..')
         shutil.rmtree(tmp_dir)
+        if cache:
+            cache.release()
 
 
 if __name__ == "__main__":
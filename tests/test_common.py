@@ -0,0 +1,85 @@
+"""Tests for the IndexedDict behind JobSet.jobs, and JobSet/DAGMan indexing."""
+
+
+import shutil
+import tempfile
+import unittest
+import htcondenser as ht
+from htcondenser.common import IndexedDict, LocalBackend, get_hdfs_backend, set_hdfs_backend
+
+
+class TestIndexedDict(unittest.TestCase):
+
+    def setUp(self):
+        self.d = IndexedDict()
+        for key, value in [('a', 1), ('b', 2), ('c', 3)]:
+            self.d[key] = value
+
+    def test_mapping(self):
+        self.assertEqual(len(self.d), 3)
+        self.assertEqual(self.d['b'], 2)
+        self.assertIn('c', self.d)
+        self.assertNotIn('x', self.d)
+        self.assertEqual(self.d.get('x', 0), 0)
+        self.assertRaises(KeyError, lambda: self.d['x'])
+
+    def test_order(self):
+        self.assertEqual(list(self.d), ['a', 'b', 'c'])
+        self.assertEqual(self.d.keys(), ['a', 'b', 'c'])
+        self.assertEqual(self.d.values(), [1, 2, 3])
+
+    def test_value_at(self):
+        self.assertEqual(self.d.value_at(0), 1)
+        self.assertEqual(self.d.value_at(-1), 3)
+        self.assertEqual(self.d.value_at(slice(1, None)), [2, 3])
+        self.assertRaises(IndexError, self.d.value_at, 3)
+
+    def test_overwrite_keeps_position(self):
+        self.d['a'] = 10
+        self.d['d'] = 4
+        self.assertEqual(self.d.keys(), ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.d.value_at(0), 10)
+        self.assertEqual(self.d.value_at(3), 4)
+
+
+class TestIndexing(unittest.TestCase):
+    """JobSet & DAGMan can be indexed by position, slice, or name."""
+
+    def setUp(self):
+        # JobSet creates its HDFS store, so keep that in a temporary directory
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_backend = get_hdfs_backend()
+        set_hdfs_backend(LocalBackend(self.tmp_dir))
+        self.job_set = ht.JobSet(exe='/bin/echo', hdfs_store='/hdfs/user/test')
+        self.jobs = [ht.Job(name='job%d' % i) for i in range(5)]
+        for job in self.jobs:
+            self.job_set.add_job(job)
+        self.dag = ht.DAGMan(filename='test.dag', status_file='test.status')
+        self.dag.add_jobs(self.jobs)
+
+    def tearDown(self):
+        set_hdfs_backend(self.old_backend)
+        shutil.rmtree(self.tmp_dir)
+
+    def check_indexing(self, container):
+        self.assertIs(container[0], self.jobs[0])
+        self.assertIs(container[-1], self.jobs[-1])
+        self.assertEqual(container[1:3], self.jobs[1:3])
+        self.assertIs(container[u'job2'], self.jobs[2])
+        self.assertEqual(list(container), self.jobs)
+        self.assertEqual(len(container), 5)
+        self.assertIn('job3', container)
+        self.assertIn(self.jobs[3], container)
+        self.assertRaises(IndexError, lambda: container[5])
+        self.assertRaises(KeyError, lambda: container['job5'])
+        self.assertRaises(TypeError, lambda: container[1.0])
+
+    def test_jobset(self):
+        self.check_indexing(self.job_set)
+
+    def test_dagman(self):
+        self.check_indexing(self.dag)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""Tests for the dependency graph of a DAG, and the DAGMan cycle check."""
+
+
+import unittest
+import htcondenser as ht
+from htcondenser.graph import DAGGraph
+
+
+def make_graph(names, edges):
+    graph = DAGGraph()
+    for name in names:
+        graph.add_node(name, job=name)
+    for parent, child in edges:
+        graph.add_edge(parent, child)
+    return graph
+
+
+class TestDAGGraph(unittest.TestCase):
+
+    def test_diamond(self):
+        graph = make_graph('ABCD', [('A', 'B'), ('A', 'C'), ('B', 'D'), ('C', 'D')])
+        self.assertEqual(graph.find_cycle(), [])
+        order = graph.topological_order()
+        self.assertEqual(sorted(order), list('ABCD'))
+        for parent, child in [('A', 'B'), ('A', 'C'), ('B', 'D'), ('C', 'D')]:
+            self.assertLess(order.index(parent), order.index(child))
+
+    def test_cycle(self):
+        graph = make_graph('ABCD', [('A', 'B'), ('B', 'C'), ('C', 'A'), ('C', 'D')])
+        cycle = graph.find_cycle()
+        self.assertEqual(cycle[0], cycle[-1])
+        self.assertEqual(sorted(cycle[:-1]), list('ABC'))
+        for parent, child in zip(cycle, cycle[1:]):
+            self.assertIn(parent, graph.parents(child))
+        self.assertRaises(RuntimeError, graph.topological_order)
+
+    def test_self_cycle(self):
+        graph = make_graph('A', [('A', 'A')])
+        self.assertEqual(graph.find_cycle(), ['A', 'A'])
+
+    def test_edges_to_missing_jobs_ignored(self):
+        graph = make_graph('AB', [('A', 'B'), ('B', 'X'), ('X', 'A')])
+        self.assertEqual(graph.find_cycle(), [])
+        self.assertEqual(graph.topological_order(), ['A', 'B'])
+
+    def test_version_changes(self):
+        graph = make_graph('AB', [])
+        version = graph.version
+        graph.add_edge('A', 'B')
+        self.assertNotEqual(graph.version, version)
+        version = graph.version
+        graph.add_edge('A', 'B')  # duplicate
+        self.assertEqual(graph.version, version)
+
+
+class TestDAGManCheckAcyclic(unittest.TestCase):
+
+    def setUp(self):
+        self.dag = ht.DAGMan(filename='test.dag', status_file='test.status')
+        self.jobs = [ht.Job(name=name) for name in 'ABCD']
+        self.dag.add_jobs(self.jobs)
+
+    def test_diamond(self):
+        self.dag.add_fan_out('A', ['B', 'C'])
+        self.dag.add_fan_in(['B', 'C'], 'D')
+        self.assertTrue(self.dag.check_acyclic())
+
+    def test_cycle(self):
+        self.dag.add_dependencies([('A', 'B'), ('B', 'C'), ('C', 'A')])
+        self.assertRaises(RuntimeError, self.dag.check_acyclic)
+
+    def test_edge_added_after_check(self):
+        self.dag.add_dependencies([('A', 'B'), ('B', 'C')])
+        self.assertTrue(self.dag.check_acyclic())
+        self.dag.add_dependencies([('C', 'A')])
+        self.assertRaises(RuntimeError, self.dag.check_acyclic)
+
+    def test_job_added_after_check(self):
+        # requirement on a job that has not been added yet is ignored, until it is
+        dag = ht.DAGMan(filename='test.dag', status_file='test.status')
+        dag.add_job(ht.Job(name='A'), requires=['B'])
+        dag.add_dependencies([('A', 'B')])
+        self.assertTrue(dag.check_acyclic())
+        dag.add_job(ht.Job(name='B'))
+        self.assertRaises(RuntimeError, dag.check_acyclic)
+
+
+if __name__ == '__main__':
+    unittest.main()
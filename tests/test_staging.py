@@ -0,0 +1,104 @@
+"""Tests for skipping unchanged files on resubmission."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from htcondenser.common import FileMirror, LocalBackend, get_hdfs_backend, set_hdfs_backend
+from htcondenser.staging import FileStager, TransferManifest
+
+
+class ManifestTestCase(unittest.TestCase):
+    """Makes an input file, its mirror, and an empty manifest."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.original = self.make_file('input.txt', 'some data')
+        self.mirror = FileMirror(self.original, '/hdfs/store/input.txt', 'input.txt')
+        self.manifest_file = os.path.join(self.tmp_dir, 'manifest.json')
+        self.manifest = TransferManifest(self.manifest_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_file(self, name, contents, mtime=1000000000):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write(contents)
+        os.utime(path, (mtime, mtime))
+        return path
+
+
+class TestTransferManifest(ManifestTestCase):
+
+    def test_not_recorded(self):
+        self.assertFalse(self.manifest.is_unchanged(self.mirror))
+
+    def test_recorded(self):
+        self.manifest.record(self.mirror)
+        self.assertTrue(self.manifest.is_unchanged(self.mirror))
+
+    def test_saved_and_loaded(self):
+        self.manifest.record(self.mirror)
+        self.manifest.save()
+        self.assertTrue(TransferManifest(self.manifest_file).is_unchanged(self.mirror))
+
+    def test_size_changed(self):
+        self.manifest.record(self.mirror)
+        self.make_file('input.txt', 'some more data')
+        self.assertFalse(self.manifest.is_unchanged(self.mirror))
+
+    def test_contents_changed_same_size(self):
+        self.manifest.record(self.mirror)
+        self.make_file('input.txt', 'SOME DATA', mtime=1000000100)
+        self.assertFalse(self.manifest.is_unchanged(self.mirror))
+
+    def test_only_mtime_changed(self):
+        self.manifest.record(self.mirror)
+        self.make_file('input.txt', 'some data', mtime=1000000100)
+        self.assertTrue(self.manifest.is_unchanged(self.mirror))
+        self.assertEqual(self.manifest.entries[self.mirror.hdfs]['mtime'], 1000000100)
+
+    def test_different_original(self):
+        self.manifest.record(self.mirror)
+        other = self.make_file('other.txt', 'some data')
+        self.assertFalse(self.manifest.is_unchanged(FileMirror(other, self.mirror.hdfs, 'input.txt')))
+
+    def test_directory_not_recorded(self):
+        os.mkdir(os.path.join(self.tmp_dir, 'dir'))
+        mirror = FileMirror(os.path.join(self.tmp_dir, 'dir'), '/hdfs/store/dir', 'dir')
+        self.manifest.record(mirror)
+        self.assertFalse(self.manifest.is_unchanged(mirror))
+
+
+class TestRemoveUnchanged(ManifestTestCase):
+
+    def setUp(self):
+        super(TestRemoveUnchanged, self).setUp()
+        self.old_backend = get_hdfs_backend()
+        self.backend = LocalBackend(os.path.join(self.tmp_dir, 'hdfs'))
+        set_hdfs_backend(self.backend)
+        self.backend.mkdirs(['/hdfs/store'])
+
+    def tearDown(self):
+        set_hdfs_backend(self.old_backend)
+        super(TestRemoveUnchanged, self).tearDown()
+
+    def test_remove_unchanged(self):
+        missing = FileMirror(self.make_file('missing.txt', 'x'), '/hdfs/store/missing.txt', 'm')
+        changed = FileMirror(self.make_file('changed.txt', 'x'), '/hdfs/store/changed.txt', 'c')
+        for mirror in [self.mirror, missing, changed]:
+            self.manifest.record(mirror)
+        for mirror in [self.mirror, changed]:
+            self.backend.copy(mirror.original, mirror.hdfs)
+        self.make_file('changed.txt', 'xyz')
+        stager = FileStager(manifest=self.manifest)
+        stager.add_mirrors([self.mirror, missing, changed])
+        self.assertEqual(stager.remove_unchanged(), [self.mirror])
+        self.assertEqual(sorted(stager.mirrors), ['/hdfs/store/changed.txt',
+                                                  '/hdfs/store/missing.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()